@@ -1,6 +1,362 @@
+from typing import Dict, List, Optional, Tuple, Union
+
 import torch
+import torch.nn.functional as F
 from torch import nn
 
+# Per-layer (keys, values) cache; each tensor is (1, nhead, seq_len, d_head)
+KVCache = List[Tuple[torch.Tensor, torch.Tensor]]
+
+################################################################################
+# Causal Self-Attention with a Key/Value Cache
+################################################################################
+
+
+class CausalSelfAttention(nn.Module):
+    """
+    Multi-head causal self-attention that can reuse keys/values from earlier calls.
+
+    Keys and values of already-processed positions are passed in as ``past_kv``
+    and concatenated with those of the new positions, so a decode step only
+    projects the newest token and attends from a single query. ``past_kv`` may also
+    be a ``PagedLayerKV``, in which case new keys/values are written into its blocks,
+    or, when ``positions`` is given, a pair of fixed-size buffers written in place.
+
+    Args:
+        d_model (int): Dimensionality of the hidden states.
+        nhead (int): Number of attention heads.
+    """
+
+    def __init__(self, d_model, nhead):
+        super().__init__()
+        self.nhead = nhead
+        self.d_head = d_model // nhead
+        # Fused projection for queries, keys and values
+        self.qkv = nn.Linear(d_model, 3 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        past_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        positions: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Attend from the new positions to all cached and new positions.
+
+        Args:
+            x (torch.Tensor): Hidden states of the new positions (seq_len, d_model).
+            past_kv (tuple or PagedLayerKV, optional): Cached (keys, values) of
+                earlier positions.
+            positions (torch.Tensor, optional): Absolute positions of ``x``. If
+                given, ``past_kv`` is a static cache of (1, nhead, max_len, d_head)
+                buffers that the new keys/values are written into.
+
+        Returns:
+            tuple: (output, present_kv)
+                - output (torch.Tensor): Attention output (seq_len, d_model).
+                - present_kv (tuple): (keys, values) covering past and new positions.
+        """
+        seq_len = x.size(0)
+        q, k, v = self.qkv(x).chunk(3, dim=-1)
+        # (seq_len, d_model) -> (1, nhead, seq_len, d_head)
+        q, k, v = [
+            t.view(1, seq_len, self.nhead, self.d_head).transpose(1, 2)
+            for t in (q, k, v)
+        ]
+        if positions is not None:
+            # Static cache: shapes never change, so slots past each query's position
+            # (stale or never written) are masked out instead of sliced off
+            k = past_kv[0].index_copy_(2, positions, k)
+            v = past_kv[1].index_copy_(2, positions, v)
+            if seq_len > 1:
+                # Static prefill starts at position 0, where is_causal's top-left
+                # alignment is exactly "slots at or before the query's position"
+                mask = None
+            else:
+                slots = torch.arange(k.size(2), device=x.device)
+                mask = slots <= positions.unsqueeze(-1)
+        else:
+            if isinstance(past_kv, PagedLayerKV):
+                # Store into the sequence's blocks and gather every cached position
+                k, v = past_kv.append(k, v)
+            elif past_kv is not None:
+                k = torch.cat([past_kv[0], k], dim=2)
+                v = torch.cat([past_kv[1], v], dim=2)
+            total_len = k.size(2)
+
+            if total_len == seq_len or seq_len == 1:
+                # Prefill (causal mask applied inside the kernel) or a single query
+                # that may see every key: no mask tensor is built at all
+                mask = None
+            else:
+                # New position i sits at absolute index (total_len - seq_len + i)
+                # and may only attend to keys at or before it (True = attend).
+                # is_causal aligns the mask to the top-left, which is wrong here.
+                mask = torch.ones(
+                    seq_len, total_len, dtype=torch.bool, device=x.device
+                ).tril(total_len - seq_len)
+        # Fused attention: dispatches to a Flash / memory-efficient kernel where
+        # available, so softmax(QK^T) is never materialized as a separate tensor
+        out = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=mask, is_causal=mask is None and seq_len > 1
+        )
+        out = out.transpose(1, 2).reshape(seq_len, -1)
+        return self.out_proj(out), (k, v)
+
+
+class DecoderLayer(nn.Module):
+    """
+    A post-norm Transformer block (attention + feedforward), mirroring the layout of
+    ``nn.TransformerEncoderLayer`` but with causal, cacheable self-attention.
+
+    Args:
+        d_model (int): Dimensionality of the hidden states.
+        nhead (int): Number of attention heads.
+        dim_feedforward (int): Size of the feedforward network.
+        dropout (float): Dropout probability (inactive in eval mode).
+    """
+
+    def __init__(self, d_model, nhead, dim_feedforward=128, dropout=0.1):
+        super().__init__()
+        self.self_attn = CausalSelfAttention(d_model, nhead)
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x, past_kv=None, positions=None):
+        attn, present_kv = self.self_attn(x, past_kv, positions)
+        x = self.norm1(x + self.dropout(attn))
+        ff = self.linear2(self.dropout(torch.relu(self.linear1(x))))
+        x = self.norm2(x + self.dropout(ff))
+        return x, present_kv
+
+
+def truncate_kv(kv, length: int):
+    """
+    Roll a KV cache back to its first ``length`` positions.
+
+    Slicing along the sequence dimension returns views, so no memory is copied. For
+    a ``PagedSequence``, blocks past the new end are returned to the pool instead.
+    """
+    if isinstance(kv, PagedSequence):
+        kv.truncate(length)
+        return kv
+    return [(k[:, :, :length], v[:, :, :length]) for k, v in kv]
+
+
+################################################################################
+# Paged KV Cache: Block-Allocated Key/Value Storage
+################################################################################
+
+
+class PagedKVCache:
+    """
+    Key/value storage carved into fixed-size blocks, in the style of PagedAttention.
+
+    All sequences share one pool of blocks. Each sequence owns a block table mapping
+    its logical blocks (positions ``[i * block_size, (i + 1) * block_size)``) to
+    physical blocks anywhere in the pool. Sequences grow a block at a time instead
+    of reallocating contiguous buffers, so memory does not fragment as sequences of
+    different lengths come and go, and rolling back rejected speculative tokens just
+    returns whole blocks to the free list.
+
+    With ``kv_cache_dtype`` set to ``"fp8_e4m3"`` or ``"int8"``, keys and values are
+    stored in one byte per element with a scale per position and head, computed
+    when they are written, and are dequantized to ``dtype`` when read back. Decode
+    streams the whole cache every step, so this halves (vs. 16-bit) or quarters
+    (vs. 32-bit) the cache bytes it moves.
+
+    Args:
+        num_layers (int): Number of attention layers to store keys/values for.
+        nhead (int): Number of attention heads.
+        d_head (int): Dimensionality of each head.
+        num_blocks (int): Number of blocks in the pool.
+        block_size (int): Number of positions per block.
+        device (torch.device, optional): Device to allocate the pool on.
+        dtype (torch.dtype): Dtype keys and values are written and read in.
+        kv_cache_dtype (str): Storage format: ``"auto"`` (``dtype``), ``"fp8_e4m3"``
+            or ``"int8"``.
+    """
+
+    def __init__(
+        self,
+        num_layers,
+        nhead,
+        d_head,
+        num_blocks,
+        block_size=32,
+        device=None,
+        dtype=torch.float32,
+        kv_cache_dtype="auto",
+    ):
+        # Slot s of a layer's pool is offset (s % block_size) of block (s // block_size)
+        shape = (num_layers, num_blocks * block_size, nhead, d_head)
+        self.dtype = dtype
+        self.kv_cache_dtype = kv_cache_dtype
+        if kv_cache_dtype == "auto":
+            storage_dtype = dtype
+        elif kv_cache_dtype == "fp8_e4m3":
+            # Raw bytes of float8_e4m3fn values; indexing ops are uint8-safe
+            storage_dtype = torch.uint8
+        elif kv_cache_dtype == "int8":
+            storage_dtype = torch.int8
+        else:
+            raise ValueError(f"Unsupported kv_cache_dtype: {kv_cache_dtype}")
+        self.k_pool = torch.zeros(shape, dtype=storage_dtype, device=device)
+        self.v_pool = torch.zeros(shape, dtype=storage_dtype, device=device)
+        if kv_cache_dtype != "auto":
+            # One scale per (slot, head), broadcast over d_head
+            scale_shape = shape[:-1] + (1,)
+            self.k_scale = torch.ones(scale_shape, dtype=dtype, device=device)
+            self.v_scale = torch.ones(scale_shape, dtype=dtype, device=device)
+        self.block_size = block_size
+        self.free_blocks = list(range(num_blocks))
+        self.block_tables: Dict[int, List[int]] = {}
+
+    @classmethod
+    def for_model(
+        cls, model: nn.Module, max_tokens, block_size=32, kv_cache_dtype="auto"
+    ):
+        """Create a pool with room for ``max_tokens`` positions of ``model``."""
+        attn = model.layers[0].self_attn
+        param = next(model.parameters())
+        num_blocks = -(-max_tokens // block_size)  # Ceiling division
+        return cls(
+            len(model.layers),
+            attn.nhead,
+            attn.d_head,
+            num_blocks,
+            block_size=block_size,
+            device=param.device,
+            dtype=param.dtype,
+            kv_cache_dtype=kv_cache_dtype,
+        )
+
+    def sequence(self, seq_id) -> "PagedSequence":
+        """Return a ``past_kv`` handle for ``seq_id``, registering it if new."""
+        self.block_tables.setdefault(seq_id, [])
+        return PagedSequence(self, seq_id)
+
+    def truncate(self, seq_id, length):
+        """Keep the first ``length`` positions of a sequence and free later blocks."""
+        table = self.block_tables[seq_id]
+        keep = -(-length // self.block_size)
+        self.free_blocks.extend(table[keep:])
+        del table[keep:]
+
+    def free(self, seq_id):
+        """Release every block of a sequence."""
+        self.truncate(seq_id, 0)
+        del self.block_tables[seq_id]
+
+    def quantize(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Scale ``x`` per position and head into the storage format."""
+        if self.kv_cache_dtype == "fp8_e4m3":
+            # Largest finite float8_e4m3fn value
+            scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-12) / 448.0
+            return (x / scale).to(torch.float8_e4m3fn).view(torch.uint8), scale
+        scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-12) / 127.0
+        return (x / scale).round().to(torch.int8), scale
+
+    def dequantize(self, q: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+        """Inverse of ``quantize``, returning values in ``dtype``."""
+        if self.kv_cache_dtype == "fp8_e4m3":
+            q = q.view(torch.float8_e4m3fn)
+        return q.to(self.dtype) * scale
+
+    def slots(self, seq_id, end) -> torch.Tensor:
+        """Pool slots of positions ``[0, end)``, allocating blocks as needed."""
+        table = self.block_tables[seq_id]
+        while len(table) * self.block_size < end:
+            if not self.free_blocks:
+                raise RuntimeError("PagedKVCache has no free blocks left")
+            table.append(self.free_blocks.pop())
+        positions = torch.arange(end, device=self.k_pool.device)
+        blocks = torch.tensor(table, device=self.k_pool.device)
+        return blocks[positions // self.block_size] * self.block_size + (
+            positions % self.block_size
+        )
+
+
+class PagedSequence:
+    """
+    Handle to one sequence of a ``PagedKVCache``, passed to the model as ``past_kv``.
+
+    The model writes new keys/values into the sequence's blocks and returns the same
+    handle as its updated cache.
+    """
+
+    def __init__(self, cache: PagedKVCache, seq_id):
+        self.cache = cache
+        self.seq_id = seq_id
+
+    def layers(self, start_pos, num_new) -> List["PagedLayerKV"]:
+        """Per-layer views for a forward over ``[start_pos, start_pos + num_new)``."""
+        # Slots are computed once per forward and shared by every layer
+        read_slots = self.cache.slots(self.seq_id, start_pos + num_new)
+        write_slots = read_slots[start_pos:]
+        return [
+            PagedLayerKV(self.cache, layer, write_slots, read_slots)
+            for layer in range(self.cache.k_pool.size(0))
+        ]
+
+    def truncate(self, length):
+        """Keep the first ``length`` positions and free later blocks."""
+        self.cache.truncate(self.seq_id, length)
+
+
+class PagedLayerKV:
+    """One layer's view of a ``PagedSequence`` during a single forward."""
+
+    def __init__(self, cache: PagedKVCache, layer, write_slots, read_slots):
+        self.cache = cache
+        self.k_pool = cache.k_pool[layer]
+        self.v_pool = cache.v_pool[layer]
+        if cache.kv_cache_dtype != "auto":
+            self.k_scale = cache.k_scale[layer]
+            self.v_scale = cache.v_scale[layer]
+        self.write_slots = write_slots
+        self.read_slots = read_slots
+
+    def append(
+        self, k: torch.Tensor, v: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Store keys/values of the new positions and gather those of all positions.
+
+        Args:
+            k (torch.Tensor): New keys (1, nhead, num_new, d_head).
+            v (torch.Tensor): New values (1, nhead, num_new, d_head).
+
+        Returns:
+            tuple: (keys, values), each (1, nhead, start_pos + num_new, d_head).
+        """
+        # (1, nhead, num_new, d_head) -> (num_new, nhead, d_head), the pool layout
+        k, v = k[0].transpose(0, 1), v[0].transpose(0, 1)
+        if self.cache.kv_cache_dtype == "auto":
+            self.k_pool[self.write_slots] = k
+            self.v_pool[self.write_slots] = v
+            keys = self.k_pool[self.read_slots]
+            values = self.v_pool[self.read_slots]
+        else:
+            k_q, k_scale = self.cache.quantize(k)
+            v_q, v_scale = self.cache.quantize(v)
+            self.k_pool[self.write_slots] = k_q
+            self.v_pool[self.write_slots] = v_q
+            self.k_scale[self.write_slots] = k_scale
+            self.v_scale[self.write_slots] = v_scale
+            keys = self.cache.dequantize(
+                self.k_pool[self.read_slots], self.k_scale[self.read_slots]
+            )
+            values = self.cache.dequantize(
+                self.v_pool[self.read_slots], self.v_scale[self.read_slots]
+            )
+        return keys.transpose(0, 1).unsqueeze(0), values.transpose(0, 1).unsqueeze(0)
+
+
 ################################################################################
 # SimpleTransformerLM: A Minimal Transformer-based Language Model
 ################################################################################
@@ -13,50 +369,270 @@ class SimpleTransformerLM(nn.Module):
     This model consists of:
       - Token embedding layer: maps token indices to dense vectors.
       - Positional embedding layer: encodes the position of each token in the sequence.
-      - Transformer encoder: processes the embedded sequence.
+      - Decoder layers: causal self-attention + feedforward blocks with a KV cache.
       - Output head: projects the final hidden states to vocabulary logits.
 
+    The forward pass has two phases:
+      - Prefill (``past_kv=None``): process the whole prompt and build the cache.
+      - Decode: process only the new tokens, attending to the cached keys/values,
+        so each generated token costs a single-query forward.
+
+    ``prefill`` and ``decode_one`` run the same two phases over a fixed-size cache
+    with fixed input shapes (prompts are padded to a few length buckets), so each
+    is compiled by ``torch.compile`` once per shape instead of recompiling as the
+    sequence grows.
+
     Args:
         vocab_size (int): Number of tokens in the vocabulary.
         d_model (int): Dimensionality of the embeddings and hidden states.
         nhead (int): Number of attention heads in the Transformer.
-        num_layers (int): Number of Transformer encoder layers.
-        dim_feedforward (int): Size of the feedforward network in each encoder layer.
+        num_layers (int): Number of Transformer layers.
+        dim_feedforward (int): Size of the feedforward network in each layer.
+        max_seq_len (int): Maximum sequence length (positions and static cache).
+        max_prefill_len (int, optional): Longest prompt ``prefill`` accepts;
+            defaults to ``max_seq_len``.
+        use_compile (bool): Compile ``prefill`` and ``decode_one`` when the model
+            runs on a CUDA device (Inductor's CPU backend needs a C++ toolchain).
     """
 
-    def __init__(self, vocab_size, d_model, nhead, num_layers, dim_feedforward=128):
+    def __init__(
+        self,
+        vocab_size,
+        d_model,
+        nhead,
+        num_layers,
+        dim_feedforward=128,
+        max_seq_len=512,
+        max_prefill_len=None,
+        use_compile=True,
+    ):
         super().__init__()
+        self.max_seq_len = max_seq_len
+        self.max_prefill_len = max_prefill_len or max_seq_len
+        self.use_compile = use_compile
         # Token embedding: maps token indices to vectors
         self.embedding = nn.Embedding(vocab_size, d_model)
-        # Positional embedding: encodes position information (max length 512)
-        self.pos_embedding = nn.Embedding(512, d_model)
-        # Transformer encoder: stack of self-attention + feedforward layers
-        encoder_layer = nn.TransformerEncoderLayer(
-            d_model=d_model, nhead=nhead, dim_feedforward=dim_feedforward
+        # Positional embedding: encodes position information
+        self.pos_embedding = nn.Embedding(max_seq_len, d_model)
+        # Stack of causal self-attention + feedforward layers
+        self.layers = nn.ModuleList(
+            [
+                DecoderLayer(d_model, nhead, dim_feedforward=dim_feedforward)
+                for _ in range(num_layers)
+            ]
         )
-        self.transformer = nn.TransformerEncoder(encoder_layer, num_layers=num_layers)
         # Output head: projects hidden states to logits over the vocabulary
         self.output_head = nn.Linear(d_model, vocab_size)
+        # Shape-specialized compiled entry points, built on first use on CUDA
+        self._compiled_prefill = None
+        self._compiled_decode = None
+        # Static KV cache, allocated on the first prefill and reused afterwards
+        self._kv_cache: Optional[KVCache] = None
 
-    def forward(self, tokens: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        tokens: torch.Tensor,
+        past_kv: Optional[KVCache] = None,
+        start_pos: int = 0,
+    ) -> Tuple[torch.Tensor, KVCache]:
         """
         Forward pass of the language model.
 
         Args:
-            tokens (torch.Tensor): 1D tensor of token indices (sequence length,).
+            tokens (torch.Tensor): 1D tensor of token indices (sequence length,). When
+                ``past_kv`` is given, only the tokens not yet in the cache.
+            past_kv (KVCache or PagedSequence, optional): Per-layer cache from a
+                previous call, or a paged sequence to read from and write into.
+            start_pos (int): Absolute position of ``tokens[0]`` in the sequence.
+
+        Returns:
+            tuple: (logits, present_kv)
+                - logits (torch.Tensor): Logits for each new position (sequence length, vocab_size).
+                - present_kv (KVCache): Per-layer cache covering all positions so far.
+        """
+        hidden, present_kv = self.encode(tokens, past_kv, start_pos)
+        # Project to vocabulary logits
+        return self.head(hidden), present_kv
+
+    def forward_greedy(
+        self,
+        tokens: torch.Tensor,
+        positions: Union[List[int], slice],
+        past_kv: Optional[KVCache] = None,
+        start_pos: int = 0,
+    ) -> Tuple[torch.Tensor, KVCache]:
+        """
+        Greedy next-token predictions at selected positions only.
+
+        Hidden states are sliced *before* the vocabulary projection, so the output
+        head runs on ``len(positions)`` rows instead of every position and the full
+        (sequence length, vocab_size) logits tensor is never materialized.
+
+        Args:
+            tokens (torch.Tensor): Same as in ``forward``.
+            positions (list[int] or slice): Indices into ``tokens`` to predict after.
+            past_kv (KVCache, optional): Same as in ``forward``.
+            start_pos (int): Same as in ``forward``.
+
+        Returns:
+            tuple: (predictions, present_kv)
+                - predictions (torch.Tensor): Most likely next token (int64) for each
+                  requested position.
+                - present_kv (KVCache): Per-layer cache covering all positions so far.
+        """
+        hidden, present_kv = self.encode(tokens, past_kv, start_pos)
+        return self.head(hidden[positions]).argmax(dim=-1), present_kv
+
+    def prefill(self, tokens: torch.Tensor) -> Tuple[torch.Tensor, KVCache]:
+        """
+        Process a prompt into the model's static KV cache.
+
+        When compiled, the prompt is padded to a power-of-two length bucket so only
+        a handful of shapes are ever compiled. Each layer's cache holds
+        ``max_seq_len`` positions; slots past the position being decoded are
+        masked, so rolling the cache back only means calling ``decode_one`` at an
+        earlier position. The cache is allocated once and overwritten by every
+        prefill, so a compiled decode step always sees the same cache tensors.
+
+        Args:
+            tokens (torch.Tensor): 1D tensor of prompt token indices.
 
         Returns:
-            torch.Tensor: Logits for each position (sequence length, vocab_size).
+            tuple: (logits, kv_cache)
+                - logits (torch.Tensor): Next-token logits after the last prompt
+                  token (vocab_size,); no other position is projected.
+                - kv_cache (KVCache): Static per-layer cache to pass to ``decode_one``.
         """
         seq_len = tokens.size(0)
-        # Create position indices [0, 1, ..., seq_len-1]
-        positions = torch.arange(seq_len, device=tokens.device)
+        if seq_len > self.max_prefill_len:
+            raise ValueError(
+                f"Prompt length {seq_len} exceeds "
+                f"max_prefill_len={self.max_prefill_len}"
+            )
+        compiled = self._use_compiled(tokens.device)
+        weight = self.output_head.weight
+        if self._kv_cache is None or self._kv_cache[0][0].device != weight.device:
+            attn = self.layers[0].self_attn
+            shape = (1, attn.nhead, self.max_seq_len, attn.d_head)
+            self._kv_cache = [
+                (weight.new_zeros(shape), weight.new_zeros(shape)) for _ in self.layers
+            ]
+            if compiled:
+                # Like parameters, static addresses are neither copied into CUDA
+                # graph inputs on every replay nor treated as mutated graph inputs
+                # by the in-place cache writes, which would disable the graph
+                for layer_kv in self._kv_cache:
+                    for t in layer_kv:
+                        torch._dynamo.mark_static_address(t)
+        kv_cache = self._kv_cache
+        # Passed as a tensor so the compiled graph does not specialize on its value
+        last = torch.full((1,), seq_len - 1, device=tokens.device)
+        if compiled:
+            tokens = F.pad(tokens, (0, self._prefill_bucket(seq_len) - seq_len))
+            logits = self._compiled_prefill(tokens, kv_cache, last)
+        else:
+            logits = self._prefill_impl(tokens, kv_cache, last)
+        return logits[0], kv_cache
+
+    def decode_one(
+        self, token: torch.Tensor, kv_cache: KVCache, position: int
+    ) -> Tuple[torch.Tensor, KVCache]:
+        """
+        Process a single token at ``position`` against a static KV cache.
+
+        Args:
+            token (torch.Tensor): One-element tensor holding the token to feed.
+            kv_cache (KVCache): Cache from ``prefill``; updated in place.
+            position (int): Absolute position of ``token`` in the sequence.
+
+        Returns:
+            tuple: (logits, kv_cache)
+                - logits (torch.Tensor): Next-token logits (vocab_size,).
+                - kv_cache (KVCache): The same cache, now covering ``position``.
+        """
+        if position >= self.max_seq_len:
+            raise ValueError(
+                f"Position {position} exceeds max_seq_len={self.max_seq_len}"
+            )
+        # Passed as a tensor so the compiled graph does not specialize on its value
+        positions = torch.full((1,), position, device=token.device)
+        if self._use_compiled(token.device):
+            logits = self._compiled_decode(token, kv_cache, positions)
+        else:
+            logits = self._decode_one_impl(token, kv_cache, positions)
+        return logits[0], kv_cache
+
+    def _use_compiled(self, device):
+        """Whether to run the compiled entry points, compiling them on first use."""
+        if not self.use_compile or device.type != "cuda":
+            return False
+        if self._compiled_prefill is None:
+            self._compiled_prefill = torch.compile(self._prefill_impl, dynamic=False)
+            # Decode replays as a CUDA graph (reduce-overhead)
+            self._compiled_decode = torch.compile(
+                self._decode_one_impl, mode="reduce-overhead", dynamic=False
+            )
+        return True
+
+    def _prefill_bucket(self, seq_len):
+        """Smallest power of two >= ``seq_len`` (at least 16), capped at the limit."""
+        bucket = 16
+        while bucket < seq_len:
+            bucket *= 2
+        return min(bucket, self.max_prefill_len)
+
+    def _prefill_impl(self, tokens, kv_cache, last):
+        positions = torch.arange(tokens.size(0), device=tokens.device)
+        hidden = self._static_encode(tokens, kv_cache, positions)
+        # Gather before the head: padded and earlier rows are never projected
+        return self.head(hidden[last])
+
+    def _decode_one_impl(self, token, kv_cache, positions):
+        return self.head(self._static_encode(token, kv_cache, positions))
+
+    def _static_encode(self, tokens, kv_cache, positions):
+        """Hidden states at ``positions``, writing keys/values into ``kv_cache``."""
+        x = self.embedding(tokens) + self.pos_embedding(positions)
+        for layer, layer_kv in zip(self.layers, kv_cache):
+            x, _ = layer(x, layer_kv, positions)
+        return x
+
+    def head(self, hidden: torch.Tensor) -> torch.Tensor:
+        """Project hidden states (..., d_model) to vocabulary logits (..., vocab_size)."""
+        return self.output_head(hidden)
+
+    def encode(
+        self,
+        tokens: torch.Tensor,
+        past_kv: Optional[KVCache] = None,
+        start_pos: int = 0,
+    ) -> Tuple[torch.Tensor, KVCache]:
+        """
+        Run embeddings and decoder layers, without the output head.
+
+        Args:
+            tokens (torch.Tensor): Same as in ``forward``.
+            past_kv (KVCache or PagedSequence, optional): Same as in ``forward``.
+            start_pos (int): Same as in ``forward``.
+
+        Returns:
+            tuple: (hidden, present_kv)
+                - hidden (torch.Tensor): Final hidden states (sequence length, d_model).
+                - present_kv (KVCache): Per-layer cache covering all positions so far.
+        """
+        seq_len = tokens.size(0)
+        # Absolute position indices [start_pos, ..., start_pos+seq_len-1]
+        positions = torch.arange(start_pos, start_pos + seq_len, device=tokens.device)
         # Add token and positional embeddings
         x = self.embedding(tokens) + self.pos_embedding(positions)
-        # Transformer expects (sequence, batch, features); add batch dim
-        x = self.transformer(x.unsqueeze(1)).squeeze(1)
-        # Project to vocabulary logits
-        return self.output_head(x)
+        paged = isinstance(past_kv, PagedSequence)
+        layer_past = past_kv.layers(start_pos, seq_len) if paged else past_kv
+        present_kv = []
+        for i, layer in enumerate(self.layers):
+            x, layer_kv = layer(x, None if layer_past is None else layer_past[i])
+            present_kv.append(layer_kv)
+        # A paged cache is updated in place; the handle itself is the new cache
+        return x, past_kv if paged else present_kv
 
 
 ################################################################################
@@ -64,10 +640,19 @@ class SimpleTransformerLM(nn.Module):
 ################################################################################
 
 
+@torch.inference_mode()
 def greedy_decode(model: nn.Module, context, max_new_tokens):
     """
     Naive greedy decoding: generates tokens one at a time, always picking the most likely next token.
 
+    The context is processed once (prefill); every later step feeds only the newest
+    token and reuses the model's KV cache for all earlier positions. Both phases go
+    through the model's fixed-shape ``prefill``/``decode_one``, so a compiled model
+    does not recompile as the sequence grows. Tokens live in a
+    buffer allocated once on the model's device, so the loop never builds tensors
+    from Python lists or waits on the device to read back a token. Runs under
+    ``torch.inference_mode()``, so no autograd bookkeeping is done per op.
+
     Args:
         model (nn.Module): The language model to use for generation.
         context (list[int]): List of token indices to start from.
@@ -78,17 +663,27 @@ def greedy_decode(model: nn.Module, context, max_new_tokens):
             - generated_tokens (list[int]): The new tokens generated (not including the context).
             - num_model_calls (int): Number of times the model was called.
     """
-    tokens = list(context)  # Copy context to avoid modifying input
+    device = next(model.parameters()).device
+    context_len = len(context)
+    # Context followed by room for every generated token
+    tokens = torch.empty(context_len + max_new_tokens, dtype=torch.long, device=device)
+    tokens[:context_len].copy_(torch.tensor(context))
+    length = context_len
     calls = 0
+    kv = None
     for _ in range(max_new_tokens):
-        # Run the model on the current sequence
-        logits = model(torch.tensor(tokens))
+        if kv is None:
+            # Prefill: run the model on the whole context and populate the cache
+            logits, kv = model.prefill(tokens[:length])
+        else:
+            # Decode: run only the newest token against the cached keys/values
+            logits, kv = model.decode_one(tokens[length - 1 : length], kv, length - 1)
         calls += 1
-        # Pick the most likely next token (greedy)
-        next_token = int(torch.argmax(logits[-1]))
-        tokens.append(next_token)
+        # Store the most likely next token (greedy) in place on device
+        tokens[length] = logits.argmax(dim=-1)
+        length += 1
     # Return only the newly generated tokens (not the context)
-    return tokens[len(context) :], calls
+    return tokens[context_len:length].tolist(), calls
 
 
 ################################################################################
@@ -96,31 +691,110 @@ def greedy_decode(model: nn.Module, context, max_new_tokens):
 ################################################################################
 
 
-def speculative_decode(target: nn.Module, draft: nn.Module, context, max_new_tokens, k):
+def draft_ahead(
+    draft: nn.Module,
+    past_kv: KVCache,
+    start_pos: int,
+    token: torch.Tensor,
+    steps: int,
+    stream: torch.cuda.Stream,
+    inputs_ready: torch.cuda.Event,
+) -> Tuple[torch.Tensor, KVCache]:
+    """
+    Optimistically keep drafting on a side CUDA stream while the target verifies.
+
+    Feeds ``token`` (the last guess of the round being verified) and then each new
+    prediction back into the draft model. Predictions never leave the device, so
+    the host can issue all ``steps`` forwards without waiting for the GPU, and are
+    written into a buffer allocated once up front.
+
+    Args:
+        draft (nn.Module): The draft language model.
+        past_kv (KVCache): Static draft cache covering every position before ``token``.
+        start_pos (int): Absolute position of ``token``.
+        token (torch.Tensor): One-element tensor holding the first token to feed.
+        steps (int): Number of single-token forwards to issue.
+        stream (torch.cuda.Stream): Stream to run the draft model on.
+        inputs_ready (torch.cuda.Event): Recorded once ``token`` and ``past_kv``
+            are written. The draft stream waits only on this, not on work queued
+            since (such as verification), so the two can overlap.
+
+    Returns:
+        tuple: (predictions, present_kv)
+            - predictions (torch.Tensor): The ``steps`` predicted tokens, on device.
+            - present_kv (KVCache): The same cache, extended by ``steps`` positions.
+    """
+    device = next(draft.parameters()).device
+    # Order after the writes of this round's draft phase only
+    stream.wait_event(inputs_ready)
+    # The caller may free ``token`` before the draft stream has read it
+    token.record_stream(stream)
+    with torch.cuda.stream(stream):
+        # Filled in place rather than collected in a list and concatenated
+        predictions = torch.empty(steps, dtype=torch.long, device=device)
+        next_input = token
+        for i in range(steps):
+            logits, past_kv = draft.decode_one(next_input, past_kv, start_pos + i)
+            predictions[i] = logits.argmax(dim=-1)
+            next_input = predictions[i : i + 1]
+    # Anything consuming the results on the default stream waits for the draft
+    torch.cuda.current_stream(device).wait_stream(stream)
+    return predictions, past_kv
+
+
+@torch.inference_mode()
+def speculative_decode(
+    target: nn.Module,
+    draft: nn.Module,
+    context,
+    max_new_tokens,
+    k,
+    collect_details=False,
+    kv_block_size=None,
+    kv_cache_dtype="auto",
+):
     """
     Speculative decoding: accelerates generation by using a fast "draft" model to propose multiple tokens,
     then verifying them in bulk with the slower, more accurate "target" model.
 
     The process:
       1. Use the draft model to greedily propose up to k tokens.
-      2. Run the target model once on the full sequence (context + generated + guesses).
+      2. Run the target model once on the guesses (plus the last accepted token),
+         reusing its KV cache for everything before them.
       3. Accept as many draft tokens as match the target model's greedy predictions.
       4. If a mismatch occurs, generate the next token from the target model and continue.
 
+    When both models live on CUDA devices, verification is launched on its own stream
+    and, while it runs, the draft model optimistically drafts the next round on a
+    second stream assuming every guess is accepted. If the target agrees, that round's
+    draft phase is skipped; otherwise the look-ahead is discarded. On the CPU the
+    target's output head is instead applied lazily, one guess at a time, up to the
+    first rejection.
+
+    Runs under ``torch.inference_mode()``, so no autograd bookkeeping is done per op.
+
     Args:
         target (nn.Module): The accurate (but slow) language model.
         draft (nn.Module): The fast, approximate model for proposing tokens.
         context (list[int]): List of token indices to start from.
         max_new_tokens (int): Number of tokens to generate.
         k (int): Number of draft tokens to propose per speculative step.
+        collect_details (bool): Record per-step, per-position acceptance details.
+            Off by default to keep dict construction out of the decode loop.
+        kv_block_size (int, optional): Keep the target's KV cache in a
+            ``PagedKVCache`` with blocks of this many positions, so rejected
+            guesses are rolled back by freeing blocks. Contiguous cache if None.
+        kv_cache_dtype (str): Storage format of the paged target cache: ``"auto"``,
+            ``"fp8_e4m3"`` or ``"int8"`` (lossy, so outputs may differ slightly from
+            greedy decoding). Only used with ``kv_block_size``.
 
     Returns:
         tuple: (generated_tokens, num_target_calls, acceptance_stats)
             - generated_tokens (list[int]): The new tokens generated (not including the context).
             - num_target_calls (int): Number of times the target model was called.
-            - acceptance_stats (dict): Statistics about acceptance rates and steps.
+            - acceptance_stats (dict): Statistics about acceptance rates and steps
+              (``acceptance_steps`` is empty unless ``collect_details`` is set).
     """
-    generated = []  # List to store generated tokens (not including context)
     target_calls = 0  # Counter for target model calls
     context_len = len(context)
 
@@ -129,78 +803,219 @@ def speculative_decode(target: nn.Module, draft: nn.Module, context, max_new_tok
     total_accepted = 0
     acceptance_steps = []
 
-    while len(generated) < max_new_tokens:
+    # Both models' KV caches are kept across rounds and rolled back on rejection.
+    # The draft's is static (see SimpleTransformerLM.prefill), so rolling it back
+    # only moves draft_cached; the target's is truncated.
+    draft_kv = None
+    draft_cached = 0  # Number of valid positions in draft_kv
+    target_kv = None
+    target_cached = 0  # Number of positions held in target_kv
+    if kv_block_size is not None:
+        target_kv = PagedKVCache.for_model(
+            target,
+            context_len + max_new_tokens,
+            block_size=kv_block_size,
+            kv_cache_dtype=kv_cache_dtype,
+        ).sequence(0)
+
+    draft_device = next(draft.parameters()).device
+    target_device = next(target.parameters()).device
+    # Pipeline draft and verification on separate streams when both are on CUDA
+    overlap = draft_device.type == "cuda" and target_device.type == "cuda"
+    if overlap:
+        draft_stream = torch.cuda.Stream(device=draft_device)
+        target_stream = torch.cuda.Stream(device=target_device)
+    # On the CPU, project target logits only up to the first rejected guess; on an
+    # accelerator the per-row checks would each stall on a device sync
+    lazy_head = target_device.type == "cpu"
+    next_guesses = None  # Guesses for the next round, drafted during verification
+    # Draft guesses are written here on the draft device
+    draft_buf = torch.empty(k, dtype=torch.long, device=draft_device)
+
+    # Context, generated tokens and the current round's guesses share one buffer on
+    # the target device, so building model inputs is slicing rather than copying
+    # Python lists to the device every round
+    tokens = torch.empty(
+        context_len + max_new_tokens, dtype=torch.long, device=target_device
+    )
+    tokens[:context_len].copy_(torch.tensor(context))
+    gen_len = 0  # Number of generated tokens (not including context)
+
+    while gen_len < max_new_tokens:
+        offset = context_len + gen_len  # Position of the first guess
+
         # -------------------------------
         # 1. Draft phase: propose up to k tokens using the draft model
         # -------------------------------
-        guesses = []
-        draft_input = torch.tensor(context + generated)
-        for _ in range(k):
-            logits = draft(draft_input)
-            # Greedily pick the most likely next token
-            guess = int(torch.argmax(logits[-1]))
-            guesses.append(guess)
-            # Append the guess to the input for the next draft step
-            draft_input = torch.cat([draft_input, torch.tensor([guess])])
-            # Stop if we've reached the desired total number of tokens
-            if len(generated) + len(guesses) >= max_new_tokens:
-                break
+        if next_guesses is not None:
+            # The previous round's look-ahead was confirmed; reuse its guesses
+            num_guesses = next_guesses.size(0)
+            tokens[offset : offset + num_guesses].copy_(next_guesses)
+            guesses_on_draft = next_guesses
+            next_guesses = None
+        else:
+            # Only feed positions the draft cache has not seen yet: the whole
+            # context in the first round, afterwards the tokens added since
+            draft_input = tokens[draft_cached:offset].to(draft_device)
+            if draft_kv is None:
+                logits, draft_kv = draft.prefill(draft_input)
+            else:
+                # One fixed-shape step per token keeps the compiled graph reusable
+                for j in range(draft_input.size(0)):
+                    logits, draft_kv = draft.decode_one(
+                        draft_input[j : j + 1], draft_kv, draft_cached + j
+                    )
+            draft_cached = offset
+            # Don't draft past the desired total number of tokens
+            num_guesses = min(k, max_new_tokens - gen_len)
+            for i in range(num_guesses):
+                if i > 0:
+                    # Next draft step is a single-token update against the cache
+                    logits, draft_kv = draft.decode_one(
+                        draft_buf[i - 1 : i], draft_kv, draft_cached
+                    )
+                    draft_cached += 1
+                # Greedily pick the most likely next token
+                draft_buf[i] = logits.argmax(dim=-1)
+            tokens[offset : offset + num_guesses].copy_(draft_buf[:num_guesses])
+            guesses_on_draft = draft_buf[:num_guesses]
+        guesses = tokens[offset : offset + num_guesses]
+        if overlap:
+            # The look-ahead below depends on nothing queued after this point
+            draft_ready = torch.cuda.Event()
+            draft_ready.record(torch.cuda.current_stream(draft_device))
 
         # -------------------------------
         # 2. Verification phase: check guesses with the target model
         # -------------------------------
-        # Run the target model once on the full sequence (context + generated + guesses)
-        full_sequence = context + generated + guesses
-        logits = target(torch.tensor(full_sequence))
+        # Run the target model once on everything its cache has not seen: the whole
+        # context in the first round (prefill), afterwards the last accepted token
+        # followed by the guesses
+        verify_input = tokens[target_cached : offset + num_guesses]
+        # Only project the positions that predict each guess plus the one after
+        # the last guess; preds[i] is the target's choice for guess i
+        verify_positions = slice(offset - 1 - target_cached, None)
+        if lazy_head:
+            # Nothing waits on a device here, so scan the guesses in order and run
+            # the output head on one row at a time, stopping at the first rejected
+            # guess: the rows after it are never projected
+            hidden, target_kv = target.encode(
+                verify_input, past_kv=target_kv, start_pos=target_cached
+            )
+            hidden = hidden[verify_positions]
+            preds = torch.empty(num_guesses + 1, dtype=torch.long)
+            accepted = 0
+            for i in range(num_guesses + 1):
+                preds[i] = target.head(hidden[i]).argmax()
+                if i == num_guesses or preds[i] != guesses[i]:
+                    break
+                accepted += 1
+            preds = preds[: accepted + 1]
+        elif overlap:
+            # Queue verification on the target stream; the host does not block here.
+            # The current stream joins it only after the look-ahead is launched.
+            target_stream.wait_stream(torch.cuda.current_stream(target_device))
+            with torch.cuda.stream(target_stream):
+                preds, target_kv = target.forward_greedy(
+                    verify_input,
+                    verify_positions,
+                    past_kv=target_kv,
+                    start_pos=target_cached,
+                )
+        else:
+            preds, target_kv = target.forward_greedy(
+                verify_input,
+                verify_positions,
+                past_kv=target_kv,
+                start_pos=target_cached,
+            )
         target_calls += 1
 
-        # Determine how many draft guesses match the target model's greedy predictions
-        offset = context_len + len(generated)  # Start of guesses in logits
-        accepted = 0
-        acceptance_details = []
+        # While verification is in flight, draft the next round as if all guesses
+        # are accepted: feed the last guess, predict the bonus token, then next_k
+        # guesses that follow it
+        lookahead = None
+        next_k = min(k, max_new_tokens - gen_len - num_guesses - 1)
+        if overlap and next_k > 0:
+            # Fed from the draft-side copy of the guesses, so the look-ahead has no
+            # dependency on the target device
+            lookahead = draft_ahead(
+                draft,
+                draft_kv,
+                draft_cached,
+                guesses_on_draft[-1:],
+                next_k + 1,
+                draft_stream,
+                draft_ready,
+            )
+        if overlap:
+            torch.cuda.current_stream(target_device).wait_stream(target_stream)
+
+        if not lazy_head:
+            # Determine how many draft guesses match the target model's greedy
+            # predictions: the length of the all-matching prefix, found with one
+            # vectorized comparison and a single device sync instead of one per guess
+            matches = preds[:num_guesses] == guesses
+            accepted = int(matches.to(torch.int8).cumprod(dim=0).sum())
 
-        for i, g in enumerate(guesses):
-            # For each guess, get the target model's prediction at that position
-            target_pred = int(torch.argmax(logits[offset + i]))
-            is_accepted = target_pred == g
-            acceptance_details.append(
+        # Track statistics
+        total_guesses += num_guesses
+        total_accepted += accepted
+        if collect_details:
+            # Per-position details up to and including the first mismatch
+            draft_guesses = guesses.tolist()
+            target_preds = preds.tolist()
+            acceptance_details = [
                 {
-                    "position": len(generated) + i,
+                    "position": gen_len + i,
                     "draft_guess": g,
-                    "target_prediction": target_pred,
-                    "accepted": is_accepted,
+                    "target_prediction": target_preds[i],
+                    "accepted": target_preds[i] == g,
+                }
+                for i, g in enumerate(draft_guesses[: accepted + 1])
+            ]
+            acceptance_steps.append(
+                {
+                    "step": len(acceptance_steps) + 1,
+                    "guesses": draft_guesses,
+                    "accepted": accepted,
+                    "acceptance_rate": accepted / num_guesses,
+                    "details": acceptance_details,
                 }
             )
 
-            if is_accepted:
-                accepted += 1  # Accept if it matches
-            else:
-                break  # Stop at first mismatch
-
-        # Track statistics
-        total_guesses += len(guesses)
-        total_accepted += accepted
-        acceptance_steps.append(
-            {
-                "step": len(acceptance_steps) + 1,
-                "guesses": guesses,
-                "accepted": accepted,
-                "acceptance_rate": accepted / len(guesses) if guesses else 0,
-                "details": acceptance_details,
-            }
-        )
+        # Drop cached positions for rejected guesses so the next round resumes
+        # from the accepted prefix. The target's next token is not cached yet; it
+        # is fed at the start of the next verification.
+        draft_cached = min(draft_cached, offset + accepted)
+        target_cached = offset + accepted
+        target_kv = truncate_kv(target_kv, target_cached)
 
-        # Append all accepted guesses to the generated sequence
-        generated.extend(guesses[:accepted])
+        # Accepted guesses are already in place in the buffer
+        gen_len += accepted
 
         # -------------------------------
         # 3. If a mismatch occurred (or if we need more tokens), generate one from target
         # -------------------------------
-        if len(generated) < max_new_tokens:
-            # The next token to generate is at position (context + generated)
-            position = context_len + len(generated)
-            token = int(torch.argmax(logits[position]))
-            generated.append(token)
+        if gen_len < max_new_tokens:
+            # The target's prediction right after the accepted guesses: its
+            # correction at the first mismatch, or a bonus token if all matched.
+            # Written on device, overwriting the first rejected guess if any.
+            tokens[context_len + gen_len] = preds[accepted]
+            gen_len += 1
+
+        # -------------------------------
+        # 4. Keep the look-ahead only if every guess and the bonus token matched
+        # -------------------------------
+        if lookahead is not None:
+            predictions, lookahead_kv = lookahead
+            if accepted == num_guesses and int(preds[accepted]) == int(predictions[0]):
+                next_guesses = predictions[1:]
+                # The look-ahead predictions were allocated on the draft stream; its
+                # cache writes went into draft_kv's existing buffers
+                predictions.record_stream(torch.cuda.current_stream(draft_device))
+                draft_kv = lookahead_kv
+                draft_cached += next_k + 1
 
     # Compile acceptance statistics
     acceptance_stats = {
@@ -213,9 +1028,53 @@ def speculative_decode(target: nn.Module, draft: nn.Module, context, max_new_tok
         "target_calls": target_calls,
     }
 
+    # Only the generated tokens are copied back to the host
+    generated = tokens[context_len : context_len + gen_len].tolist()
     return generated, target_calls, acceptance_stats
 
 
+################################################################################
+# Draft Model Distillation: Making a Small Draft Agree with the Target
+################################################################################
+
+
+def distill(
+    student: nn.Module, teacher: nn.Module, vocab_size, steps=300, seq_len=24, lr=1e-2
+):
+    """
+    Train a small draft model to imitate the target's next-token distributions.
+
+    Minimizes KL(teacher || student) at every position of random token sequences.
+    A draft only pays off when it is much cheaper than the target *and* usually
+    agrees with it; distillation buys the agreement without copying the weights.
+
+    Args:
+        student (nn.Module): The draft model to train.
+        teacher (nn.Module): The target model to imitate (kept frozen).
+        vocab_size (int): Number of tokens in the shared vocabulary.
+        steps (int): Number of optimization steps.
+        seq_len (int): Length of each random training sequence.
+        lr (float): Adam learning rate.
+    """
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    student.train()
+    for _ in range(steps):
+        tokens = torch.randint(vocab_size, (seq_len,))
+        with torch.no_grad():
+            teacher_logits, _ = teacher(tokens)
+        student_logits, _ = student(tokens)
+        loss = F.kl_div(
+            student_logits.log_softmax(dim=-1),
+            teacher_logits.log_softmax(dim=-1),
+            log_target=True,
+            reduction="batchmean",
+        )
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    student.eval()
+
+
 ################################################################################
 # Example Usage: Comparing Greedy and Speculative Decoding
 ################################################################################
@@ -229,29 +1088,27 @@ if __name__ == "__main__":
     d_model = 64
     nhead = 4
 
-    # Create the target (accurate) and draft (fast) models with identical architecture
+    # Create the target (accurate) model and a much smaller draft (fast) model over the
+    # same vocabulary: half the width, half the heads, one layer and a smaller FFN.
+    # A draft as large as the target costs as much per forward as the target itself,
+    # so speculation could never beat plain greedy decoding.
     target_model = SimpleTransformerLM(
         vocab_size, d_model=d_model, nhead=nhead, num_layers=2
     )
     draft_model = SimpleTransformerLM(
-        vocab_size, d_model=d_model, nhead=nhead, num_layers=2
+        vocab_size,
+        d_model=d_model // 2,
+        nhead=nhead // 2,
+        num_layers=1,
+        dim_feedforward=64,
     )
 
-    # Initialize draft model with the same weights as target model
-    # Since both models have identical architecture, we can copy all weights
-    with torch.no_grad():
-        target_state_dict = target_model.state_dict()
-        draft_model.load_state_dict(target_state_dict)
-
-    # For demonstration, share embeddings and output head weights so the draft model
-    # is a good approximation of the target (makes speculative decoding more effective)
-    draft_model.embedding = target_model.embedding
-    draft_model.pos_embedding = target_model.pos_embedding
-    draft_model.output_head = target_model.output_head
-
-    # Set both models to evaluation mode (disables dropout, etc.)
+    # Set the target to evaluation mode (disables dropout, etc.)
     target_model.eval()
-    draft_model.eval()
+
+    # Widths differ, so no weights can be shared with the target; instead distill the
+    # draft from the target so its greedy choices mostly agree (leaves it in eval mode)
+    distill(draft_model, target_model, vocab_size)
 
     # Define the context (prompt) and decoding parameters
     context = [10, 20]  # Start sequence (token indices)
@@ -263,7 +1120,7 @@ if __name__ == "__main__":
 
     # Run speculative decoding (calls the target model less frequently)
     spec_tokens, spec_calls, acceptance_stats = speculative_decode(
-        target_model, draft_model, context, max_new_tokens, k
+        target_model, draft_model, context, max_new_tokens, k, collect_details=True
     )
 
     # Print results for comparison
@@ -296,5 +1153,6 @@ if __name__ == "__main__":
             )
 
     # Output explanation:
-    # - The two generated sequences should be similar (since draft ≈ target).
+    # - The two generated sequences are identical: verification only keeps tokens
+    #   the target itself would have picked greedily.
     # - Speculative decoding should require fewer target model calls than naive decoding.
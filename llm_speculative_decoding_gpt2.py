@@ -25,15 +25,17 @@ License: MIT
 """
 
 import argparse
+import hashlib
 import json
 import logging
 import time
-from dataclasses import dataclass, asdict
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
 
 # =============================================================================
 # Configuration Management
@@ -53,11 +55,18 @@ class SpeculativeDecodingConfig:
     target_model_name: str = "gpt2"
     draft_model_name: str = "distilbert/distilgpt2"
     model_dtype: str = "float16"  # "float16", "bfloat16", "float32"
+    quantization: str = "none"  # "none", "int8", "nf4" (weight-only, bitsandbytes)
+    draft_quantization: Optional[str] = None  # Overrides quantization for the draft
+    check_quantization_drift: bool = False  # Compare quantized logits on load
+    max_quantization_drift: float = 0.05  # Relative logit L1 drift before warning
 
     # Device Configuration
     target_device: str = "cuda:0"
     draft_device: str = "cuda:1"
     auto_device_map: bool = True  # Automatically map devices if multi-GPU unavailable
+    cpu_draft_fallback: bool = True  # Small drafts not fitting a lone GPU use the CPU
+    cpu_draft_max_params: int = 200_000_000  # Largest draft eligible for CPU fallback
+    colocate_models: bool = True  # Put the draft on the target's GPU if it fits
 
     # Generation Parameters
     speculation_length: int = 4  # Number of tokens to speculate (K)
@@ -70,6 +79,18 @@ class SpeculativeDecodingConfig:
     batch_size: int = 1
     max_sequence_length: int = 2048
     use_cache: bool = True
+    use_compile: bool = True  # torch.compile both models (CUDA devices only)
+    # "reduce-overhead" would re-record a CUDA graph for every KV cache length;
+    # the draft's decode graph comes from DraftDecodeGraph instead
+    compile_mode: str = "default"
+    draft_cuda_graph: bool = True  # Replay the draft's single-token step as a graph
+    prefill_bucket: int = 64  # Smallest prefill length; buckets double from here
+    # Each prefill bucket is one static-shape compile of the model's forward, which
+    # shares dynamo's recompile limit (torch._dynamo.config.cache_size_limit,
+    # 8 by default) with the decode variant's specializations, so the buckets
+    # are capped and longer prompts run eagerly
+    max_prefill_buckets: int = 4
+    prompt_cache_size: int = 128  # Tokenized prompts kept for reuse (0 disables)
 
     # Logging and Monitoring
     log_level: str = "INFO"
@@ -79,6 +100,7 @@ class SpeculativeDecodingConfig:
     # Safety and Validation
     max_speculation_length: int = 10
     min_acceptance_rate: float = 0.1  # Minimum acceptance rate to continue speculation
+    max_draft_size_ratio: float = 0.75  # Largest allowed draft/target parameter ratio
     fallback_to_standard: bool = (
         True  # Fall back to standard generation if speculation fails
     )
@@ -96,6 +118,19 @@ class SpeculativeDecodingConfig:
                 f"1 and {self.max_speculation_length}"
             )
 
+        # Validate draft/target size ratio
+        if not 0 < self.max_draft_size_ratio <= 1:
+            raise ValueError(
+                f"max_draft_size_ratio ({self.max_draft_size_ratio}) must be in (0, 1]"
+            )
+
+        # Validate prefill buckets
+        if self.prefill_bucket < 1 or self.max_prefill_buckets < 1:
+            raise ValueError(
+                f"prefill_bucket ({self.prefill_bucket}) and max_prefill_buckets "
+                f"({self.max_prefill_buckets}) must be positive"
+            )
+
         # Validate temperature
         if self.temperature <= 0:
             raise ValueError(f"temperature ({self.temperature}) must be positive")
@@ -119,6 +154,15 @@ class SpeculativeDecodingConfig:
             raise ValueError(f"model_dtype must be one of {list(dtype_map.keys())}")
         self._torch_dtype = dtype_map[self.model_dtype]
 
+        # Validate quantization mode
+        quantization_modes = ["none", "int8", "nf4"]
+        if self.quantization not in quantization_modes:
+            raise ValueError(f"quantization must be one of {quantization_modes}")
+        if self.draft_quantization is None:
+            self.draft_quantization = self.quantization
+        elif self.draft_quantization not in quantization_modes:
+            raise ValueError(f"draft_quantization must be one of {quantization_modes}")
+
     @property
     def torch_dtype(self) -> torch.dtype:
         """Get the PyTorch dtype for model loading."""
@@ -212,23 +256,19 @@ class SpeculationMetrics:
     total_tokens_generated: int = 0
     total_speculation_rounds: int = 0
     total_accepted_tokens: int = 0
+    total_draft_tokens: int = 0
+    total_accepted_draft_tokens: int = 0
     total_inference_time: float = 0.0
     draft_inference_time: float = 0.0
+    draft_prefill_time: float = 0.0  # Part of draft_inference_time
     target_inference_time: float = 0.0
 
     @property
     def acceptance_rate(self) -> float:
-        """Calculate the overall token acceptance rate."""
-        if self.total_speculation_rounds == 0:
+        """Calculate the fraction of proposed draft tokens that were accepted."""
+        if self.total_draft_tokens == 0:
             return 0.0
-        total_speculated = (
-            self.total_speculation_rounds * 4
-        )  # Assuming K=4, should be parameterized
-        return (
-            self.total_accepted_tokens / total_speculated
-            if total_speculated > 0
-            else 0.0
-        )
+        return self.total_accepted_draft_tokens / self.total_draft_tokens
 
     @property
     def tokens_per_second(self) -> float:
@@ -251,8 +291,11 @@ class SpeculationMetrics:
             "total_tokens_generated": self.total_tokens_generated,
             "total_speculation_rounds": self.total_speculation_rounds,
             "total_accepted_tokens": self.total_accepted_tokens,
+            "total_draft_tokens": self.total_draft_tokens,
+            "total_accepted_draft_tokens": self.total_accepted_draft_tokens,
             "total_inference_time": self.total_inference_time,
             "draft_inference_time": self.draft_inference_time,
+            "draft_prefill_time": self.draft_prefill_time,
             "target_inference_time": self.target_inference_time,
             "acceptance_rate": self.acceptance_rate,
             "tokens_per_second": self.tokens_per_second,
@@ -279,8 +322,20 @@ class ModelManager:
         self.tokenizer: Optional[AutoTokenizer] = None
         self.target_model: Optional[AutoModelForCausalLM] = None
         self.draft_model: Optional[AutoModelForCausalLM] = None
+        # Variants used for prefill forwards; compiled separately from decode
+        self.target_prefill_model: Optional[AutoModelForCausalLM] = None
+        self.draft_prefill_model: Optional[AutoModelForCausalLM] = None
+        # Whether the prefill variants are compiled; their inputs are then padded
+        self.target_prefill_compiled = False
+        self.draft_prefill_compiled = False
+        # Uncompiled models, for prefills longer than the largest bucket
+        self.target_eager_model: Optional[AutoModelForCausalLM] = None
+        self.draft_eager_model: Optional[AutoModelForCausalLM] = None
         self.target_device: torch.device = None
         self.draft_device: torch.device = None
+        self.draft_dtype: torch.dtype = config.torch_dtype
+        # Meta-device parameter counts by model name
+        self._param_counts: Dict[str, int] = {}
 
     def initialize(self) -> None:
         """Initialize tokenizer and models with proper device placement."""
@@ -315,18 +370,42 @@ class ModelManager:
             try:
                 self.target_device = torch.device(self.config.target_device)
                 self.draft_device = torch.device(self.config.draft_device)
-                self.logger.info(f"Target model device: {self.target_device}")
-                self.logger.info(f"Draft model device: {self.draft_device}")
             except RuntimeError as e:
                 self.logger.error(f"Failed to set up specified devices: {e}")
                 raise
+            # Draft and verification run one after the other, so sharing a GPU
+            # costs the target no compute, while on separate GPUs ids and draft
+            # distributions cross PCIe every round
+            if (
+                self.config.colocate_models
+                and self.draft_device != self.target_device
+                and self._models_fit_on(self.target_device)
+            ):
+                self.logger.info("Draft model fits next to the target, colocating")
+                self.draft_device = self.target_device
+            self.logger.info(f"Target model device: {self.target_device}")
+            self.logger.info(f"Draft model device: {self.draft_device}")
         elif available_gpus == 1:
             if self.config.auto_device_map:
-                self.logger.info(
-                    "Only 1 GPU available, using same device for both models"
-                )
                 self.target_device = torch.device("cuda:0")
-                self.draft_device = torch.device("cuda:0")
+                # Same policy as with two GPUs: colocate when both models fit, and
+                # only move a small draft to the CPU when the GPU is too full
+                if self.config.colocate_models and self._models_fit_on(
+                    self.target_device
+                ):
+                    self.logger.info("Draft model fits next to the target, colocating")
+                    self.draft_device = self.target_device
+                elif self._use_cpu_draft():
+                    self.logger.info(
+                        "Only 1 GPU available, running draft model on CPU in bfloat16"
+                    )
+                    self.draft_device = torch.device("cpu")
+                    self.draft_dtype = torch.bfloat16
+                else:
+                    self.logger.info(
+                        "Only 1 GPU available, using same device for both models"
+                    )
+                    self.draft_device = torch.device("cuda:0")
             else:
                 raise RuntimeError(
                     "Insufficient GPUs available and auto_device_map=False"
@@ -334,6 +413,38 @@ class ModelManager:
         else:
             raise RuntimeError("No GPUs available for inference")
 
+    def _use_cpu_draft(self) -> bool:
+        """Whether the draft model is small enough to run on the CPU instead."""
+        if not self.config.cpu_draft_fallback:
+            return False
+        draft_params = self._count_parameters(self.config.draft_model_name)
+        self.logger.info(f"Draft model parameters: {draft_params:,}")
+        return draft_params < self.config.cpu_draft_max_params
+
+    def _models_fit_on(self, device: torch.device) -> bool:
+        """Whether both models' weights fit in ``device``'s free memory."""
+        target_params = self._count_parameters(self.config.target_model_name)
+        draft_params = self._count_parameters(self.config.draft_model_name)
+        bytes_per_param = torch.finfo(self.config.torch_dtype).bits // 8
+        weight_bytes = (target_params + draft_params) * bytes_per_param
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        # Leave headroom for activations and KV caches
+        return weight_bytes < 0.8 * free_bytes
+
+    def _count_parameters(self, model_name: str) -> int:
+        """
+        Count a model's parameters from its config without loading weights.
+
+        Unlike ``numel()`` on a loaded model, the count is unaffected by
+        quantization: bitsandbytes packs two 4-bit weights per element.
+        """
+        if model_name not in self._param_counts:
+            model_config = AutoConfig.from_pretrained(model_name)
+            with torch.device("meta"):
+                model = AutoModelForCausalLM.from_config(model_config)
+            self._param_counts[model_name] = sum(p.numel() for p in model.parameters())
+        return self._param_counts[model_name]
+
     def _load_tokenizer(self) -> None:
         """Load and configure the tokenizer."""
         self.logger.info(f"Loading tokenizer: {self.config.target_model_name}")
@@ -342,8 +453,14 @@ class ModelManager:
             self.tokenizer = AutoTokenizer.from_pretrained(
                 self.config.target_model_name,
                 padding_side="left",  # Important for batch processing
+                use_fast=True,  # Rust tokenizers backend
             )
 
+            if not self.tokenizer.is_fast:
+                self.logger.warning(
+                    "No fast tokenizer available; long prompts will tokenize slowly"
+                )
+
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
                 self.logger.info("Set pad_token to eos_token")
@@ -358,20 +475,33 @@ class ModelManager:
 
     def _load_models(self) -> None:
         """Load target and draft models with proper configuration."""
+        # A draft that is nearly as large as the target costs almost as much per
+        # forward, so k draft steps plus verification end up slower than plain
+        # autoregressive decoding no matter how many tokens are accepted. Checked
+        # before any weights are loaded.
+        target_params = self._count_parameters(self.config.target_model_name)
+        draft_params = self._count_parameters(self.config.draft_model_name)
+        draft_ratio = draft_params / target_params
+        if draft_ratio > self.config.max_draft_size_ratio:
+            raise ValueError(
+                f"Draft model is {draft_ratio:.2f}x the size of the target model "
+                f"(max_draft_size_ratio={self.config.max_draft_size_ratio}); "
+                "speculative decoding needs a much smaller draft to pay off"
+            )
+
         self.logger.info("Loading models...")
 
         # Load target model
         self.logger.info(f"Loading target model: {self.config.target_model_name}")
         try:
-            self.target_model = AutoModelForCausalLM.from_pretrained(
+            self.target_model = self._load_pretrained(
                 self.config.target_model_name,
-                torch_dtype=self.config.torch_dtype,
-                device_map=None,  # We handle device placement manually
-                trust_remote_code=False,  # Security best practice
-            ).to(self.target_device)
+                self.target_device,
+                self.config.torch_dtype,
+                self.config.quantization,
+            )
 
             self.target_model.eval()
-            target_params = sum(p.numel() for p in self.target_model.parameters())
             self.logger.info(f"Target model loaded. Parameters: {target_params:,}")
 
         except Exception as e:
@@ -381,15 +511,14 @@ class ModelManager:
         # Load draft model
         self.logger.info(f"Loading draft model: {self.config.draft_model_name}")
         try:
-            self.draft_model = AutoModelForCausalLM.from_pretrained(
+            self.draft_model = self._load_pretrained(
                 self.config.draft_model_name,
-                torch_dtype=self.config.torch_dtype,
-                device_map=None,
-                trust_remote_code=False,
-            ).to(self.draft_device)
+                self.draft_device,
+                self.draft_dtype,
+                self.config.draft_quantization,
+            )
 
             self.draft_model.eval()
-            draft_params = sum(p.numel() for p in self.draft_model.parameters())
             self.logger.info(f"Draft model loaded. Parameters: {draft_params:,}")
 
             # Log model size ratio
@@ -402,6 +531,208 @@ class ModelManager:
             self.logger.error(f"Failed to load draft model: {e}")
             raise
 
+        self.target_eager_model = self.target_prefill_model = self.target_model
+        self.draft_eager_model = self.draft_prefill_model = self.draft_model
+        if self.config.use_compile:
+            self.target_prefill_model, self.target_prefill_compiled = (
+                self._compile_prefill(self.target_model, self.target_device, "target")
+            )
+            self.draft_prefill_model, self.draft_prefill_compiled = (
+                self._compile_prefill(self.draft_model, self.draft_device, "draft")
+            )
+            self.target_model = self._compile_model(
+                self.target_model, self.target_device, "target"
+            )
+            if self.config.draft_cuda_graph and self.draft_device.type == "cuda":
+                # The draft's decode step is captured into its own CUDA graph,
+                # which cannot contain torch.compile's graphs
+                self.logger.info("Skipping torch.compile for draft model (CUDA graph)")
+            else:
+                self.draft_model = self._compile_model(
+                    self.draft_model, self.draft_device, "draft"
+                )
+
+    def _load_pretrained(
+        self,
+        model_name: str,
+        device: torch.device,
+        dtype: torch.dtype,
+        quantization: str,
+    ) -> AutoModelForCausalLM:
+        """Load a model onto ``device``, quantizing its weights as requested."""
+        load_kwargs = {
+            "torch_dtype": dtype,
+            "device_map": None,  # We handle device placement manually
+            "trust_remote_code": False,  # Security best practice
+        }
+        quantization_kwargs = self._quantization_kwargs(device, quantization)
+        load_kwargs.update(quantization_kwargs)
+
+        model = AutoModelForCausalLM.from_pretrained(model_name, **load_kwargs)
+        # Inference only: no parameter needs autograd tracking
+        model.requires_grad_(False)
+        if not quantization_kwargs:
+            return model.to(device)
+
+        # bitsandbytes already placed the weights; they cannot be moved afterwards
+        model.eval()
+        if self.config.check_quantization_drift:
+            self._check_quantization_drift(model, model_name, device, quantization)
+        return model
+
+    def _compile_model(
+        self, model: AutoModelForCausalLM, device: torch.device, role: str
+    ) -> AutoModelForCausalLM:
+        """
+        Compile a model's cached-decode calls with ``torch.compile`` and warm it up.
+
+        This variant always runs new tokens against a ``past_key_values`` cache
+        that grows every round, so after the first recompile the input and cache
+        lengths are treated as dynamic instead of specializing on every length.
+        The warmup uses that same call signature, so no compile happens
+        mid-generation.
+        """
+        if device.type != "cuda":
+            self.logger.info(f"Skipping torch.compile for {role} model on {device}")
+            return model
+
+        self.logger.info(f"Compiling {role} model (mode={self.config.compile_mode})")
+        compiled = torch.compile(model, mode=self.config.compile_mode)
+
+        # Length 1 (a single-token draft step) is always specialized separately;
+        # of the multi-token calls, the second length triggers the dynamic-shape
+        # recompile and the third checks that it is reused
+        warmup_start = time.time()
+        with torch.inference_mode():
+            prefix_ids = torch.full((1, 8), self.tokenizer.eos_token_id, device=device)
+            past_key_values = model(prefix_ids, use_cache=True).past_key_values
+            for length in (1, 4, 5, 6):
+                warmup_ids = prefix_ids[:, :length]
+                past_key_values = compiled(
+                    warmup_ids, past_key_values=past_key_values, use_cache=True
+                ).past_key_values
+        self.logger.info(
+            f"{role.capitalize()} model compiled in {time.time() - warmup_start:.1f}s"
+        )
+        return compiled
+
+    def _compile_prefill(
+        self, model: AutoModelForCausalLM, device: torch.device, role: str
+    ) -> Tuple[AutoModelForCausalLM, bool]:
+        """
+        Compile a prefill-only variant of a model with static shapes.
+
+        Prefill inputs are right-padded to a power-of-two multiple of
+        ``prefill_bucket``, at most ``max_prefill_buckets`` shapes, so each bucket
+        compiles once and later prompts of any length in it hit the cache. Warmup
+        compiles every bucket for the cache-less call, the only prefill outside
+        the draft's CUDA graph, so those never compile mid-generation. CUDA
+        graphs are left to the decode variant: a prefill graph would be recorded
+        per bucket and replayed rarely.
+
+        Returns:
+            The prefill model and whether it was compiled
+        """
+        if device.type != "cuda":
+            return model, False
+        self.logger.info(f"Compiling {role} model prefill variant (static shapes)")
+        compiled = torch.compile(model, dynamic=False)
+
+        warmup_start = time.time()
+        length = self.config.prefill_bucket
+        with torch.inference_mode():
+            for _ in range(self.config.max_prefill_buckets):
+                if length > model.config.max_position_embeddings:
+                    break
+                warmup_ids = torch.full(
+                    (1, length), self.tokenizer.eos_token_id, device=device
+                )
+                compiled(warmup_ids, use_cache=True)
+                length *= 2
+        self.logger.info(
+            f"{role.capitalize()} prefill variant compiled in "
+            f"{time.time() - warmup_start:.1f}s"
+        )
+        return compiled, True
+
+    def _quantization_kwargs(
+        self, device: torch.device, quantization: str
+    ) -> Dict[str, object]:
+        """
+        Build ``from_pretrained`` arguments for weight-only quantized loading.
+
+        Decode streams every weight once per token, so int8 (or 4-bit NF4) weights
+        roughly halve (or quarter) the bytes moved per step.
+        """
+        if quantization == "none":
+            return {}
+        if device.type != "cuda":
+            self.logger.warning(
+                f"{quantization} quantization requires CUDA, "
+                f"loading model on {device} unquantized"
+            )
+            return {}
+
+        # Imported lazily: bitsandbytes is only needed when quantizing
+        from transformers import BitsAndBytesConfig
+
+        if quantization == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=self.config.torch_dtype,
+            )
+        return {
+            "quantization_config": quantization_config,
+            "device_map": {"": str(device)},
+        }
+
+    def _check_quantization_drift(
+        self,
+        model: AutoModelForCausalLM,
+        model_name: str,
+        device: torch.device,
+        quantization: str,
+    ) -> None:
+        """
+        Compare a quantized model's logits with an unquantized reference.
+
+        Runs one short sample prompt through both and warns when the mean absolute
+        logit difference, relative to the reference, exceeds
+        ``max_quantization_drift``. The float32 reference is loaded on the CPU, so
+        the check never needs GPU memory for an unquantized copy of the model.
+        """
+        sample_ids = self.tokenizer(
+            "The quick brown fox jumps over the lazy dog.", return_tensors="pt"
+        ).input_ids
+
+        reference = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float32,
+            device_map=None,
+            trust_remote_code=False,
+        )
+        reference.eval()
+
+        with torch.inference_mode():
+            quantized_logits = model(sample_ids.to(device)).logits.float().cpu()
+            reference_logits = reference(sample_ids).logits
+
+        del reference
+
+        drift = (
+            (quantized_logits - reference_logits).abs().mean()
+            / reference_logits.abs().mean()
+        ).item()
+        self.logger.info(f"{model_name} {quantization} logit drift: {drift:.4f}")
+        if drift > self.config.max_quantization_drift:
+            self.logger.warning(
+                f"{model_name} quantization drift {drift:.4f} exceeds "
+                f"{self.config.max_quantization_drift}; output quality may degrade"
+            )
+
     def cleanup(self) -> None:
         """Clean up model resources."""
         self.logger.info("Cleaning up model resources...")
@@ -424,6 +755,95 @@ class ModelManager:
 # =============================================================================
 
 
+class DraftDecodeGraph:
+    """
+    A draft model's single-token decode step, captured once as a CUDA graph.
+
+    Keys and values live in a transformers ``StaticCache``, so every decode step has
+    the same shapes and memory addresses. A replay reads the token and its position
+    from static input tensors and leaves the next-token logits in ``logits``; the
+    hundreds of small kernel launches of an eager step become one graph launch.
+    """
+
+    def __init__(
+        self,
+        model: AutoModelForCausalLM,
+        device: torch.device,
+        max_cache_len: int,
+        prefill_model: Optional[AutoModelForCausalLM] = None,
+    ):
+        # Imported lazily: only needed when CUDA graphs are in use
+        from transformers import StaticCache
+
+        self.model = model
+        self.prefill_model = prefill_model or model
+        self.max_cache_len = max_cache_len
+        self.cache = StaticCache(
+            config=model.config,
+            max_batch_size=1,
+            max_cache_len=max_cache_len,
+            device=device,
+            dtype=model.dtype,
+        )
+        self.input_ids = torch.zeros((1, 1), dtype=torch.long, device=device)
+        self.cache_position = torch.zeros(1, dtype=torch.long, device=device)
+        self.graph: Optional[torch.cuda.CUDAGraph] = None
+        self.logits: Optional[torch.Tensor] = None
+
+    def capture(self) -> None:
+        """Warm up and record the decode step."""
+        self.cache.reset()
+        device = self.input_ids.device
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            # Lazy initialization (cache tensors, cuBLAS handles, allocator pools)
+            # must happen before capture
+            for _ in range(2):
+                self._decode()
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.logits = self._decode()
+
+    def prefill(
+        self,
+        input_ids: torch.Tensor,
+        model: Optional[AutoModelForCausalLM] = None,
+    ) -> torch.Tensor:
+        """
+        Reset the cache, run ``input_ids`` outside the graph and return logits.
+
+        ``model`` overrides ``prefill_model`` for this call.
+        """
+        self.cache.reset()
+        cache_position = torch.arange(input_ids.shape[1], device=input_ids.device)
+        outputs = (model or self.prefill_model)(
+            input_ids,
+            past_key_values=self.cache,
+            cache_position=cache_position,
+            use_cache=True,
+        )
+        return outputs.logits
+
+    def step(self, token_id: int, position: int) -> torch.Tensor:
+        """Replay the decode step for ``token_id`` at ``position``."""
+        self.input_ids.fill_(token_id)
+        self.cache_position.fill_(position)
+        self.graph.replay()
+        return self.logits
+
+    def _decode(self) -> torch.Tensor:
+        outputs = self.model(
+            self.input_ids,
+            past_key_values=self.cache,
+            cache_position=self.cache_position,
+            use_cache=True,
+        )
+        return outputs.logits[:, -1, :]
+
+
 class SpeculativeDecoder:
     """
     Production-ready implementation of speculative decoding for language models.
@@ -442,6 +862,35 @@ class SpeculativeDecoder:
         self.model_manager = model_manager
         self.logger = logger
         self.metrics = SpeculationMetrics()
+        # Per-token draft acceptance probability, smoothed over recent rounds
+        self._ewma_p = 0.7
+
+        # Page-locked staging buffer for token ids copied to the model devices
+        self._host_ids = torch.empty(
+            config.max_sequence_length,
+            dtype=torch.long,
+            pin_memory=torch.cuda.is_available(),
+        )
+        self._host_ids_free: Optional[torch.cuda.Event] = None
+
+        # Token ids of the current generation on the target device; positions
+        # [0, write_ptr) hold the prompt and every token generated so far
+        self._ids_buf: Optional[torch.Tensor] = None
+
+        # Single-token input of the draft's eager decode steps, refilled in place
+        self._scalar_in = torch.zeros(
+            (1, 1), dtype=torch.long, device=model_manager.draft_device
+        )
+
+        # Draft decode step as a CUDA graph; built on first use, False if unusable
+        self._draft_graph: Union[DraftDecodeGraph, bool, None] = None
+
+        # Tokenized prompts on the CPU, keyed by SHA1 of the prompt, in LRU order
+        self._prompt_cache: OrderedDict[str, torch.Tensor] = OrderedDict()
+
+        # Target KV cache kept across speculation rounds of one generation
+        self._target_pkv = None
+        self._target_cached = 0  # Number of leading positions held in _target_pkv
 
         # Validate initialized state
         if not all(
@@ -482,25 +931,9 @@ class SpeculativeDecoder:
             ValueError: If prompt is empty or invalid
             RuntimeError: If generation fails
         """
-        # Validate inputs
-        if not prompt or not isinstance(prompt, str):
-            raise ValueError("Prompt must be a non-empty string")
-
-        # Use provided parameters or fall back to config defaults
-        max_new_tokens = max_new_tokens or self.config.max_new_tokens
-        temperature = (
-            temperature if temperature is not None else self.config.temperature
+        max_new_tokens, temperature, top_p, top_k = self._start_generation(
+            prompt, max_new_tokens, temperature, top_p, top_k
         )
-        top_p = top_p if top_p is not None else self.config.top_p
-        top_k = top_k if top_k is not None else self.config.top_k
-
-        self.logger.info(f"Starting generation with {max_new_tokens} max tokens")
-        self.logger.debug(
-            f"Generation parameters: temp={temperature}, top_p={top_p}, top_k={top_k}"
-        )
-
-        # Reset metrics for this generation
-        self.metrics = SpeculationMetrics()
 
         try:
             start_time = time.time()
@@ -536,19 +969,148 @@ class SpeculativeDecoder:
             self.logger.error(f"Generation failed: {e}")
             if self.config.fallback_to_standard and hasattr(self, "_fallback_generate"):
                 self.logger.warning("Falling back to standard generation")
-                return self._fallback_generate(prompt, max_new_tokens)
+                return self._fallback_generate(
+                    prompt, max_new_tokens, temperature, top_p, top_k
+                )
             raise RuntimeError(f"Speculative decoding failed: {e}") from e
 
+    def generate_stream(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        top_k: Optional[int] = None,
+    ) -> Iterator[str]:
+        """
+        Generate text using speculative decoding, yielding it as rounds complete.
+
+        Only the tokens accepted in each round are decoded, together with a few
+        tokens of left context so that merges across the boundary (and multi-byte
+        characters split over several tokens) come out right; text ending in an
+        incomplete character is held back until the next round. Metrics for the
+        generation are available in ``self.metrics`` once the iterator is done.
+
+        Args:
+            prompt: Input text prompt
+            max_new_tokens: Maximum tokens to generate (overrides config)
+            temperature: Sampling temperature (overrides config)
+            top_p: Nucleus sampling parameter (overrides config)
+            top_k: Top-k sampling parameter (overrides config)
+
+        Yields:
+            Newly generated text, excluding the prompt
+
+        Raises:
+            ValueError: If prompt is empty or invalid
+            RuntimeError: If generation fails
+        """
+        max_new_tokens, temperature, top_p, top_k = self._start_generation(
+            prompt, max_new_tokens, temperature, top_p, top_k
+        )
+        tokenizer = self.model_manager.tokenizer
+
+        try:
+            start_time = time.time()
+            input_ids = self._tokenize_prompt(prompt)
+            prompt_length = input_ids.shape[1]
+
+            # Text of ids before read_offset has been emitted; decoding restarts at
+            # prefix_offset to give the new ids their left context
+            prefix_offset = max(prompt_length - 5, 0)
+            read_offset = write_ptr = prompt_length
+            for write_ptr in self._speculation_rounds(
+                input_ids, max_new_tokens, temperature, top_p, top_k
+            ):
+                window = self._ids_buf[0, prefix_offset:write_ptr].tolist()
+                prefix_text = tokenizer.decode(
+                    window[: read_offset - prefix_offset], skip_special_tokens=True
+                )
+                text = tokenizer.decode(window, skip_special_tokens=True)
+                if len(text) > len(prefix_text) and not text.endswith("\ufffd"):
+                    yield text[len(prefix_text) :]
+                    prefix_offset, read_offset = read_offset, write_ptr
+
+            # Flush text held back for an incomplete character
+            if read_offset < write_ptr:
+                window = self._ids_buf[0, prefix_offset:write_ptr].tolist()
+                prefix_text = tokenizer.decode(
+                    window[: read_offset - prefix_offset], skip_special_tokens=True
+                )
+                text = tokenizer.decode(window, skip_special_tokens=True)
+                if len(text) > len(prefix_text):
+                    yield text[len(prefix_text) :]
+
+            total_time = time.time() - start_time
+            self.metrics.total_inference_time = total_time
+            self.metrics.total_tokens_generated = write_ptr - prompt_length
+
+        except Exception as e:
+            self.logger.error(f"Streaming generation failed: {e}")
+            raise RuntimeError(f"Speculative decoding failed: {e}") from e
+
+    def _start_generation(
+        self,
+        prompt: str,
+        max_new_tokens: Optional[int],
+        temperature: Optional[float],
+        top_p: Optional[float],
+        top_k: Optional[int],
+    ) -> Tuple[int, float, float, int]:
+        """
+        Validate the prompt, resolve sampling parameters and reset per-run state.
+
+        Returns:
+            Tuple of (max_new_tokens, temperature, top_p, top_k), with unset
+            parameters taken from the config
+        """
+        # Validate inputs
+        if not prompt or not isinstance(prompt, str):
+            raise ValueError("Prompt must be a non-empty string")
+
+        # Use provided parameters or fall back to config defaults
+        max_new_tokens = max_new_tokens or self.config.max_new_tokens
+        temperature = (
+            temperature if temperature is not None else self.config.temperature
+        )
+        top_p = top_p if top_p is not None else self.config.top_p
+        top_k = top_k if top_k is not None else self.config.top_k
+
+        self.logger.info(f"Starting generation with {max_new_tokens} max tokens")
+        self.logger.debug(
+            f"Generation parameters: temp={temperature}, top_p={top_p}, top_k={top_k}"
+        )
+
+        # Reset metrics and cached state for this generation
+        self.metrics = SpeculationMetrics()
+        self._ewma_p = 0.7
+        self._target_pkv = None
+        self._target_cached = 0
+
+        return max_new_tokens, temperature, top_p, top_k
+
     def _tokenize_prompt(self, prompt: str) -> torch.Tensor:
         """Tokenize input prompt with proper device placement."""
         try:
-            tokens = self.model_manager.tokenizer(
-                prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=self.config.max_sequence_length - self.config.max_new_tokens,
-            )
-            input_ids = tokens.input_ids.to(self.model_manager.target_device)
+            key = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+            cached_ids = self._prompt_cache.get(key)
+            if cached_ids is not None:
+                self._prompt_cache.move_to_end(key)
+            else:
+                tokens = self.model_manager.tokenizer(
+                    prompt,
+                    return_tensors="pt",
+                    truncation=True,
+                    max_length=(
+                        self.config.max_sequence_length - self.config.max_new_tokens
+                    ),
+                )
+                cached_ids = tokens.input_ids
+                if self.config.prompt_cache_size > 0:
+                    self._prompt_cache[key] = cached_ids
+                    if len(self._prompt_cache) > self.config.prompt_cache_size:
+                        self._prompt_cache.popitem(last=False)
+            input_ids = cached_ids.to(self.model_manager.target_device)
 
             self.logger.debug(f"Tokenized prompt: {len(input_ids[0])} tokens")
             return input_ids
@@ -565,19 +1127,57 @@ class SpeculativeDecoder:
         top_p: float,
         top_k: int,
     ) -> List[int]:
+        """
+        Run speculative decoding to completion.
+
+        Returns:
+            Prompt and generated token ids
+        """
+        write_ptr = input_ids.shape[1]
+        for write_ptr in self._speculation_rounds(
+            input_ids, max_new_tokens, temperature, top_p, top_k
+        ):
+            pass
+        # The only copy of the sequence back to the host
+        return self._ids_buf[0, :write_ptr].tolist()
+
+    def _speculation_rounds(
+        self,
+        input_ids: torch.Tensor,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+    ) -> Iterator[int]:
         """
         Main speculative decoding loop with comprehensive error handling.
 
         This implements the core algorithm:
-        1. Draft model proposes K tokens
+        1. Draft model samples K tokens
         2. Target model verifies all K tokens in parallel
-        3. Accept tokens up to first mismatch
-        4. Add one more token from target model at mismatch position
+        3. Accept each token with probability min(1, p_target / p_draft), stopping
+           at the first rejection
+        4. Add one more token from the target model: resampled from the residual
+           distribution at the rejection, or a bonus token if all were accepted
+
+        Yields:
+            Length of the sequence in ``self._ids_buf`` after each round
         """
-        generated = input_ids.tolist()[0]
+        # Sequence buffer allocated once; tokens are written in place at write_ptr
+        prompt_length = input_ids.shape[1]
+        # Room for a round's extra target token past max_new_tokens
+        capacity = max(
+            self.config.max_sequence_length, prompt_length + max_new_tokens + 1
+        )
+        self._ids_buf = torch.empty(
+            (1, capacity), dtype=torch.long, device=input_ids.device
+        )
+        self._ids_buf[:, :prompt_length] = input_ids
+        write_ptr = prompt_length
         tokens_generated = 0
         consecutive_rejections = 0
         max_consecutive_rejections = 5
+        switch_to_standard = False
 
         self.logger.debug(f"Starting generation loop, target length: {max_new_tokens}")
 
@@ -595,7 +1195,9 @@ class SpeculativeDecoder:
             try:
                 # Draft phase: generate speculative tokens
                 draft_start = time.time()
-                draft_tokens = self._draft_phase(generated, speculation_length)
+                draft_tokens, draft_probs = self._draft_phase(
+                    write_ptr, speculation_length, temperature, top_p, top_k
+                )
                 self.metrics.draft_inference_time += time.time() - draft_start
 
                 if not draft_tokens:
@@ -605,11 +1207,23 @@ class SpeculativeDecoder:
                 # Verification phase: check with target model
                 target_start = time.time()
                 accepted_count = self._verification_phase(
-                    generated, draft_tokens, temperature, top_p, top_k
+                    write_ptr, draft_tokens, draft_probs, temperature, top_p, top_k
                 )
                 self.metrics.target_inference_time += time.time() - target_start
+                self.metrics.total_draft_tokens += len(draft_tokens)
+                self.metrics.total_accepted_draft_tokens += accepted_count - 1
+
+                # The last accepted token is the target's own, not a draft token
+                round_p = (accepted_count - 1) / len(draft_tokens)
+                self._ewma_p = 0.9 * self._ewma_p + 0.1 * round_p
+
+                # A bonus token after a fully accepted round may overshoot by one
+                overshoot = tokens_generated + accepted_count - max_new_tokens
+                if overshoot > 0:
+                    accepted_count -= overshoot
 
                 # Update state based on results
+                write_ptr += accepted_count
                 tokens_generated += accepted_count
                 self.metrics.total_speculation_rounds += 1
                 self.metrics.total_accepted_tokens += accepted_count
@@ -622,6 +1236,7 @@ class SpeculativeDecoder:
                             f"Too many consecutive rejections ({consecutive_rejections}), "
                             "switching to standard generation"
                         )
+                        switch_to_standard = True
                         break
                 else:
                     consecutive_rejections = 0
@@ -631,72 +1246,144 @@ class SpeculativeDecoder:
                     f"Speculation round: {accepted_count}/{len(draft_tokens)} accepted "
                     f"in {speculation_time:.3f}s"
                 )
+                yield write_ptr
 
             except Exception as e:
                 self.logger.error(f"Error in speculation round: {e}")
                 if self.config.fallback_to_standard:
+                    switch_to_standard = True
                     break
                 raise
 
+        if switch_to_standard and tokens_generated < max_new_tokens:
+            # Finish from the tokens and target cache built so far
+            outputs = self._standard_generate(
+                self._ids_buf[:, :write_ptr],
+                max_new_tokens - tokens_generated,
+                temperature,
+                top_p,
+                top_k,
+            )
+            new_length = outputs.shape[1]
+            self._ids_buf[:, write_ptr:new_length] = outputs[:, write_ptr:]
+            tokens_generated += new_length - write_ptr
+            write_ptr = new_length
+            yield write_ptr
+
         # Log final statistics
         self.logger.info(
             f"Generation complete: {tokens_generated} tokens, "
             f"acceptance rate: {self.metrics.acceptance_rate:.1%}"
         )
 
-        return generated
-
-    def _draft_phase(self, context: List[int], k: int) -> List[int]:
+    def _draft_phase(
+        self,
+        write_ptr: int,
+        k: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+    ) -> Tuple[List[int], torch.Tensor]:
         """
-        Generate k speculative tokens using the draft model.
+        Sample k speculative tokens from the draft model.
 
         Args:
-            context: Current token sequence
+            write_ptr: Length of the current sequence in ``self._ids_buf``
             k: Number of tokens to speculate
+            temperature: Sampling temperature
+            top_p: Nucleus sampling parameter
+            top_k: Top-k sampling parameter
 
         Returns:
-            List of speculated token IDs
+            Tuple of (speculated token IDs, draft distributions they were sampled
+            from with shape (num_tokens, vocab_size))
         """
+        # Bound the number of steps by the sequence length limit once, up front
+        max_steps = self.config.max_sequence_length - write_ptr
+        if k > max_steps:
+            self.logger.warning("Reached maximum sequence length during drafting")
+            k = max(max_steps, 0)
+
         draft_tokens = []
-        current_context = torch.tensor(
-            [context], device=self.model_manager.draft_device
+        draft_probs = []
+        draft_device = self.model_manager.draft_device
+        # A non_blocking copy to the CPU returns before the ids have arrived, so
+        # only overlap device-to-device copies
+        input_ids = self._ids_buf[:, :write_ptr].to(
+            draft_device, non_blocking=draft_device.type == "cuda"
         )
-
+        past_key_values = None
+        prefill_limit = self.model_manager.draft_model.config.max_position_embeddings
+        graph = self._get_draft_graph()
+        if graph is not None and write_ptr + k > graph.max_cache_len:
+            graph = None
+        if graph is not None:
+            prefill_limit = min(prefill_limit, graph.max_cache_len)
+
+        prefill_start = time.time()
         try:
-            for step in range(k):
-                with torch.no_grad():
-                    outputs = self.model_manager.draft_model(current_context)
-                    logits = outputs.logits[:, -1, :]  # Get last token logits
-
-                    # Apply sampling (greedy for now, can be extended)
-                    next_token_id = torch.argmax(logits, dim=-1).item()
+            with torch.inference_mode():
+                for step in range(k):
+                    # The first step prefills the context; later steps feed only
+                    # the newest token and reuse the cached keys/values
+                    if step == 0:
+                        prefill_model = self.model_manager.draft_prefill_model
+                        padded_ids = self._pad_prefill(
+                            input_ids,
+                            prefill_limit,
+                            self.model_manager.draft_prefill_compiled,
+                        )
+                        if padded_ids is None:
+                            # Longer than the largest compiled bucket
+                            prefill_model = self.model_manager.draft_eager_model
+                            padded_ids = input_ids
+                        if graph is None:
+                            outputs = prefill_model(padded_ids, use_cache=True)
+                            # Drop the padding positions from the cache
+                            past_key_values = self._truncate_past_key_values(
+                                outputs.past_key_values, write_ptr
+                            )
+                            logits = outputs.logits[:, write_ptr - 1, :]
+                        else:
+                            # Padding slots are overwritten before being attended
+                            logits = graph.prefill(padded_ids, prefill_model)
+                            logits = logits[:, write_ptr - 1, :]
+                    elif graph is None:
+                        outputs = self.model_manager.draft_model(
+                            input_ids, past_key_values=past_key_values, use_cache=True
+                        )
+                        past_key_values = outputs.past_key_values
+                        logits = outputs.logits[:, -1, :]  # Get last token logits
+                    else:
+                        # Feed the token sampled in the previous step
+                        logits = graph.step(draft_tokens[-1], write_ptr + step - 1)
+
+                    # Sample from the filtered distribution; verification needs it
+                    # to compute acceptance probabilities
+                    probs = self._sampling_probs(logits[0], temperature, top_p, top_k)
+                    next_token_id = torch.multinomial(probs, 1).item()
                     draft_tokens.append(next_token_id)
+                    draft_probs.append(probs)
+                    if step == 0:
+                        # .item() synchronized, so this covers the whole prefill
+                        self.metrics.draft_prefill_time += time.time() - prefill_start
 
-                    # Append to context for next iteration
-                    next_token_tensor = torch.tensor(
-                        [[next_token_id]], device=current_context.device
-                    )
-                    current_context = torch.cat(
-                        [current_context, next_token_tensor], dim=1
-                    )
-
-                    # Check for sequence length limits
-                    if current_context.shape[1] >= self.config.max_sequence_length:
-                        self.logger.warning(
-                            "Reached maximum sequence length during drafting"
-                        )
-                        break
+                    # Next iteration's input is just the sampled token
+                    input_ids = self._scalar_in.fill_(next_token_id)
 
         except Exception as e:
             self.logger.error(f"Error in draft phase: {e}")
             raise
 
-        return draft_tokens
+        if not draft_tokens:
+            return draft_tokens, None
+        return draft_tokens, torch.stack(draft_probs)
 
     def _verification_phase(
         self,
-        context: List[int],
+        write_ptr: int,
         draft_tokens: List[int],
+        draft_probs: torch.Tensor,
         temperature: float,
         top_p: float,
         top_k: int,
@@ -704,9 +1391,26 @@ class SpeculativeDecoder:
         """
         Verify draft tokens using the target model and accept valid ones.
 
+        Uses the speculative sampling rule of Leviathan et al. / Chen et al.: draft
+        token x is accepted with probability min(1, p_target(x) / p_draft(x)); at
+        the first rejection a replacement is sampled from the normalized residual
+        max(0, p_target - p_draft). If every draft token is accepted, a bonus token
+        is sampled from the target's next distribution. The output is distributed
+        exactly as sampling from the target alone with the same parameters.
+
+        The draft tokens are written into ``self._ids_buf`` at ``write_ptr`` and
+        the target runs on a view of the buffer, so no combined sequence is built.
+        The target's KV cache is carried across rounds, so only the positions it
+        has not seen yet (the tail of the sequence plus the draft tokens) are run
+        through the model; the cache is then rolled back to the accepted prefix.
+        Accepted drafts stay in place and the target's extra token overwrites the
+        slot after them; anything past it is dead once the caller advances
+        ``write_ptr`` by the returned count.
+
         Args:
-            context: Current token sequence
+            write_ptr: Length of the current sequence in ``self._ids_buf``
             draft_tokens: Tokens proposed by draft model
+            draft_probs: Draft distributions the tokens were sampled from
             temperature: Sampling temperature
             top_p: Nucleus sampling parameter
             top_k: Top-k sampling parameter
@@ -718,40 +1422,87 @@ class SpeculativeDecoder:
             return 0
 
         try:
-            # Prepare combined sequence for target model
-            combined_sequence = context + draft_tokens
-            combined_tensor = torch.tensor(
-                [combined_sequence], device=self.model_manager.target_device
+            # Write drafts after the sequence; the target input is a view of the
+            # buffer from the first uncached position
+            cached = self._target_cached
+            num_drafts = len(draft_tokens)
+            draft_ids = self._ids_to_device(
+                draft_tokens,
+                self.model_manager.target_device,
+                out=self._ids_buf[:, write_ptr : write_ptr + num_drafts],
             )
-
-            # Get target model predictions for all positions
-            with torch.no_grad():
-                outputs = self.model_manager.target_model(combined_tensor)
+            input_view = self._ids_buf[:, cached : write_ptr + num_drafts]
+
+            # Get target model predictions for all uncached positions
+            with torch.inference_mode():
+                if self._target_pkv is None:
+                    # First round is a prefill: padded for the static-shape variant;
+                    # padding positions are truncated from the cache below
+                    target_config = self.model_manager.target_model.config
+                    prefill_model = self.model_manager.target_prefill_model
+                    padded_ids = self._pad_prefill(
+                        input_view,
+                        target_config.max_position_embeddings,
+                        self.model_manager.target_prefill_compiled,
+                    )
+                    if padded_ids is None:
+                        # Longer than the largest compiled bucket
+                        prefill_model = self.model_manager.target_eager_model
+                        padded_ids = input_view
+                    outputs = prefill_model(padded_ids, use_cache=True)
+                else:
+                    outputs = self.model_manager.target_model(
+                        input_view,
+                        past_key_values=self._target_pkv,
+                        use_cache=True,
+                    )
                 target_logits = outputs.logits
 
-            # Verify each draft token
-            accepted_count = 0
-            context_length = len(context)
-
-            for i, draft_token in enumerate(draft_tokens):
-                position = context_length + i
-                if position >= target_logits.shape[1]:
-                    break
-
-                # Get target model's prediction at this position
-                target_prediction = torch.argmax(
-                    target_logits[0, position - 1], dim=-1
-                ).item()
-
-                if target_prediction == draft_token:
-                    # Token accepted
-                    context.append(draft_token)
-                    accepted_count += 1
-                else:
-                    # Token rejected, add target model's prediction instead
-                    context.append(target_prediction)
-                    accepted_count += 1
-                    break  # Stop at first mismatch
+            # Target distributions predicting each draft position plus the one after
+            # the last draft (logits rows start at ``cached``)
+            first_row = write_ptr - 1 - cached
+            target_probs = self._sampling_probs(
+                target_logits[0, first_row : first_row + num_drafts + 1],
+                temperature,
+                top_p,
+                top_k,
+            )
+            draft_probs = draft_probs.to(target_probs.device)
+
+            # Acceptance tests for every draft position in one shot
+            rows = torch.arange(num_drafts, device=target_probs.device)
+            p_target = target_probs[rows, draft_ids[0]]
+            p_draft = draft_probs[rows, draft_ids[0]]
+            # Accept with probability min(1, p_target / p_draft)
+            draws = torch.rand(num_drafts, device=p_target.device)
+            accepted = draws * p_draft <= p_target
+            # Length of the all-accepted prefix
+            num_accepted = accepted.to(torch.int8).cumprod(dim=0).sum()
+
+            # Candidate distributions for the token after the accepted prefix: the
+            # residual max(0, p_target - p_draft) at each possible rejection, or the
+            # target's next distribution (bonus token) if every draft is accepted
+            residual = (target_probs[:num_drafts] - draft_probs).clamp(min=0)
+            # Where the distributions agree up to rounding, fall back to the target
+            degenerate = residual.sum(dim=-1, keepdim=True) <= 0
+            residual = torch.where(degenerate, target_probs[:num_drafts], residual)
+            candidates = torch.cat([residual, target_probs[num_drafts:]])
+            next_token = torch.multinomial(candidates[num_accepted], 1)[0]
+
+            # Single device-to-host sync for the whole round
+            num_accepted, next_token = torch.stack([num_accepted, next_token]).tolist()
+            # Accepted drafts are already in place; rejected slots are overwritten
+            end = write_ptr + num_accepted
+            self._ids_buf[0, end] = next_token
+            accepted_count = num_accepted + 1
+
+            # Keep cached positions up to, but not including, the last token of the
+            # updated sequence: it is re-fed next round so its logits predict the
+            # first new draft token. Cached positions past a rejection are dropped.
+            self._target_pkv = self._truncate_past_key_values(
+                outputs.past_key_values, end
+            )
+            self._target_cached = end
 
             return accepted_count
 
@@ -759,35 +1510,218 @@ class SpeculativeDecoder:
             self.logger.error(f"Error in verification phase: {e}")
             raise
 
+    def _get_draft_graph(self) -> Optional[DraftDecodeGraph]:
+        """Return the draft's CUDA-graph decode step, capturing it on first use."""
+        if self._draft_graph is None:
+            self._draft_graph = False
+            device = self.model_manager.draft_device
+            if self.config.draft_cuda_graph and device.type == "cuda":
+                try:
+                    graph = DraftDecodeGraph(
+                        self.model_manager.draft_model,
+                        device,
+                        self.config.max_sequence_length,
+                        prefill_model=self.model_manager.draft_prefill_model,
+                    )
+                    with torch.inference_mode():
+                        graph.capture()
+                    self._draft_graph = graph
+                    self.logger.info("Captured draft decode step as a CUDA graph")
+                except (ImportError, RuntimeError) as e:
+                    # StaticCache needs a recent transformers; capture errors
+                    # (including out of memory) surface as RuntimeError
+                    self.logger.warning(
+                        f"Draft CUDA graph capture failed, decoding eagerly: {e}",
+                        exc_info=True,
+                    )
+        return self._draft_graph or None
+
+    def _pad_prefill(
+        self,
+        input_ids: torch.Tensor,
+        limit: int,
+        compiled: bool,
+    ) -> Optional[torch.Tensor]:
+        """
+        Right-pad prefill ids to the smallest bucket that holds them.
+
+        Buckets are ``prefill_bucket`` doubled up to ``max_prefill_buckets - 1``
+        times, keeping the compiled prefill variant within dynamo's recompile
+        limit. With causal attention, tokens appended after the real ones cannot
+        change the real positions' logits.
+
+        Args:
+            input_ids: Prefill ids of shape (1, length)
+            limit: Longest sequence the model (or its cache) accepts
+            compiled: Whether the prefill model is the static-shape variant
+
+        Returns:
+            The padded ids, ``input_ids`` itself for an uncompiled prefill model
+            (padding would only add compute), or None if no bucket within
+            ``limit`` holds them and the prefill should run eagerly
+        """
+        if not compiled:
+            return input_ids
+        length = input_ids.shape[1]
+        largest = self.config.prefill_bucket << (self.config.max_prefill_buckets - 1)
+        padded_length = self.config.prefill_bucket
+        while padded_length < length:
+            padded_length *= 2
+        if padded_length > min(largest, limit):
+            return None
+        if padded_length == length:
+            return input_ids
+        return torch.nn.functional.pad(
+            input_ids,
+            (0, padded_length - length),
+            value=self.model_manager.tokenizer.eos_token_id,
+        )
+
+    @staticmethod
+    def _sampling_probs(
+        logits: torch.Tensor, temperature: float, top_p: float, top_k: int
+    ) -> torch.Tensor:
+        """
+        Next-token distributions after temperature, top-k and top-p filtering.
+
+        Args:
+            logits: Logits of shape (..., vocab_size)
+            temperature: Sampling temperature
+            top_p: Nucleus sampling parameter (1.0 disables it)
+            top_k: Top-k sampling parameter (0 disables it)
+
+        Returns:
+            Float32 probabilities of the same shape, zero on filtered tokens
+        """
+        logits = logits.float() / temperature
+        if top_k > 0:
+            kth_largest = torch.topk(logits, min(top_k, logits.size(-1))).values
+            logits = logits.masked_fill(logits < kth_largest[..., -1:], float("-inf"))
+        if top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            sorted_probs = sorted_logits.softmax(dim=-1)
+            # Drop a token once the tokens ranked above it already cover top_p
+            remove = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+            sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+            logits = logits.scatter(-1, sorted_indices, sorted_logits)
+        return logits.softmax(dim=-1)
+
+    @staticmethod
+    def _truncate_past_key_values(past_key_values, length: int):
+        """Roll a HuggingFace KV cache back to its first ``length`` positions."""
+        if hasattr(past_key_values, "crop"):
+            # transformers Cache objects (e.g. DynamicCache) truncate in place
+            past_key_values.crop(length)
+            return past_key_values
+        # Legacy format: per-layer (key, value) tensors of (batch, heads, seq, dim)
+        return tuple(
+            (key[:, :, :length, :], value[:, :, :length, :])
+            for key, value in past_key_values
+        )
+
+    def _ids_to_device(
+        self,
+        token_ids: List[int],
+        device: torch.device,
+        out: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Copy token ids to ``device`` as a (1, len) tensor via pinned host memory.
+
+        Unlike ``torch.tensor(..., device=...)``, the copy out of page-locked memory
+        is asynchronous, so the host can keep queueing work; kernels launched on the
+        same stream afterwards are still ordered behind it.
+
+        Args:
+            token_ids: Token ids to copy
+            device: Destination device
+            out: Optional (1, len) tensor on ``device`` to copy into instead of
+                allocating a new one
+
+        Returns:
+            Tensor of shape (1, len(token_ids)) on ``device``
+        """
+        if len(token_ids) > self._host_ids.numel():
+            raise ValueError(
+                f"Sequence of {len(token_ids)} tokens exceeds max_sequence_length"
+            )
+        # A previous copy may still be reading the staging buffer
+        if self._host_ids_free is not None:
+            self._host_ids_free.synchronize()
+            self._host_ids_free = None
+
+        host_view = self._host_ids[: len(token_ids)]
+        host_view.copy_(torch.as_tensor(token_ids, dtype=torch.long))
+        if out is not None:
+            device_ids = out.copy_(host_view.unsqueeze(0), non_blocking=True)
+        else:
+            # copy=True so a CPU destination never aliases the staging buffer
+            device_ids = host_view.to(device, non_blocking=True, copy=True)
+            device_ids = device_ids.unsqueeze(0)
+        if device.type == "cuda":
+            self._host_ids_free = torch.cuda.Event()
+            self._host_ids_free.record(torch.cuda.current_stream(device))
+        return device_ids
+
     def _get_adaptive_speculation_length(self) -> int:
         """
-        Adaptively adjust speculation length based on recent acceptance rates.
+        Choose the speculation length with the best expected throughput.
+
+        With a per-token acceptance probability p (an EWMA over recent rounds), a
+        round drafting k tokens yields (1 - p^(k+1)) / (1 - p) tokens on average,
+        counting the target's extra token. It costs one draft prefill (which also
+        yields the first draft token), k - 1 single-token draft steps and one
+        verification, each timed over the rounds so far.
 
         Returns:
             Optimal speculation length for current conditions
         """
-        base_length = self.config.speculation_length
-
-        # If we have enough data, adjust based on acceptance rate
-        if self.metrics.total_speculation_rounds > 5:
-            acceptance_rate = self.metrics.acceptance_rate
+        rounds = self.metrics.total_speculation_rounds
+        if rounds <= 5:
+            # Too few rounds for meaningful timings
+            return self.config.speculation_length
+
+        metrics = self.metrics
+        prefill_cost = metrics.draft_prefill_time / rounds
+        # Every round's first draft token comes out of the prefill
+        draft_steps = metrics.total_draft_tokens - rounds
+        step_cost = (
+            (metrics.draft_inference_time - metrics.draft_prefill_time) / draft_steps
+            if draft_steps > 0
+            else 0.0
+        )
+        target_cost = metrics.target_inference_time / rounds
+        p = min(self._ewma_p, 0.999)
 
-            if acceptance_rate > 0.8:
-                # High acceptance, try longer speculation
-                return min(base_length + 1, self.config.max_speculation_length)
-            elif acceptance_rate < 0.3:
-                # Low acceptance, reduce speculation
-                return max(1, base_length - 1)
+        def tokens_per_second(k: int) -> float:
+            expected_tokens = (1 - p ** (k + 1)) / (1 - p)
+            return expected_tokens / (prefill_cost + (k - 1) * step_cost + target_cost)
 
-        return base_length
+        return max(
+            range(1, self.config.max_speculation_length + 1), key=tokens_per_second
+        )
 
-    def _fallback_generate(self, prompt: str, max_new_tokens: int) -> str:
+    def _fallback_generate(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+    ) -> str:
         """
         Fallback to standard autoregressive generation if speculation fails.
 
+        A failure inside the speculation loop resumes from the tokens and target
+        cache built so far (see ``_speculation_rounds``); this restarts from the
+        prompt for failures outside it.
+
         Args:
             prompt: Input prompt
             max_new_tokens: Maximum tokens to generate
+            temperature: Sampling temperature
+            top_p: Nucleus sampling parameter
+            top_k: Top-k sampling parameter
 
         Returns:
             Generated text using standard method
@@ -796,16 +1730,10 @@ class SpeculativeDecoder:
 
         try:
             input_ids = self._tokenize_prompt(prompt)
-
-            with torch.no_grad():
-                outputs = self.model_manager.target_model.generate(
-                    input_ids,
-                    max_new_tokens=max_new_tokens,
-                    temperature=self.config.temperature,
-                    do_sample=self.config.temperature > 1.0,
-                    pad_token_id=self.model_manager.tokenizer.eos_token_id,
-                    use_cache=self.config.use_cache,
-                )
+            self._target_pkv = None
+            outputs = self._standard_generate(
+                input_ids, max_new_tokens, temperature, top_p, top_k
+            )
 
             return self.model_manager.tokenizer.decode(
                 outputs[0], skip_special_tokens=True
@@ -815,6 +1743,53 @@ class SpeculativeDecoder:
             self.logger.error(f"Fallback generation failed: {e}")
             raise
 
+    def _standard_generate(
+        self,
+        input_ids: torch.Tensor,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+    ) -> torch.Tensor:
+        """
+        Continue ``input_ids`` with the target model's own ``generate``.
+
+        When ``self._target_pkv`` holds the sequence's leading positions it is
+        passed along, so ``generate`` only prefills the uncached tail. Sampling
+        uses the same parameters as speculation, so a resumed tail follows the
+        same distribution as the speculative prefix.
+
+        Args:
+            input_ids: Full sequence so far, shape (1, length)
+            max_new_tokens: Maximum tokens to generate
+            temperature: Sampling temperature
+            top_p: Nucleus sampling parameter
+            top_k: Top-k sampling parameter (0 disables it)
+
+        Returns:
+            Token ids of the sequence including ``input_ids``
+        """
+        past_key_values = None
+        if self._target_pkv is not None and self._target_cached < input_ids.shape[1]:
+            # A failed round may have extended the cache in place
+            past_key_values = self._truncate_past_key_values(
+                self._target_pkv, self._target_cached
+            )
+        self._target_pkv = None
+
+        with torch.inference_mode():
+            return self.model_manager.target_model.generate(
+                input_ids,
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                do_sample=temperature > 0,
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                pad_token_id=self.model_manager.tokenizer.eos_token_id,
+                use_cache=self.config.use_cache,
+            )
+
 
 # =============================================================================
 # Command Line Interface
@@ -848,6 +1823,11 @@ Examples:
     parser.add_argument(
         "--output-file", "-o", type=str, help="Save generated text to file"
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print generated text as each speculation round completes",
+    )
 
     # Generation parameters
     parser.add_argument(
@@ -877,6 +1857,20 @@ Examples:
         default="distilbert/distilgpt2",
         help="Draft model name",
     )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default="none",
+        choices=["none", "int8", "nf4"],
+        help="Weight-only quantization for both models (requires bitsandbytes)",
+    )
+    parser.add_argument(
+        "--draft-quantization",
+        type=str,
+        default=None,
+        choices=["none", "int8", "nf4"],
+        help="Weight-only quantization for the draft model (default: --quantization)",
+    )
 
     # Device configuration
     parser.add_argument(
@@ -885,6 +1879,11 @@ Examples:
     parser.add_argument(
         "--draft-device", type=str, default="cuda:1", help="Device for draft model"
     )
+    parser.add_argument(
+        "--no-compile",
+        action="store_true",
+        help="Disable torch.compile of the target and draft models",
+    )
     parser.add_argument(
         "--auto-device-map",
         action="store_true",
@@ -930,12 +1929,15 @@ def main():
             config = SpeculativeDecodingConfig(
                 target_model_name=args.target_model,
                 draft_model_name=args.draft_model,
+                quantization=args.quantization,
+                draft_quantization=args.draft_quantization,
                 speculation_length=args.speculation_length,
                 max_new_tokens=args.max_tokens,
                 temperature=args.temperature,
                 target_device=args.target_device,
                 draft_device=args.draft_device,
                 auto_device_map=args.auto_device_map,
+                use_compile=not args.no_compile,
                 log_level=args.log_level,
                 enable_metrics=args.metrics,
             )
@@ -955,27 +1957,45 @@ def main():
 
         # Generate text
         logger.info("Starting text generation...")
-        result = decoder.generate(
-            prompt=args.prompt,
-            max_new_tokens=args.max_tokens,
-            temperature=args.temperature,
-            return_metrics=args.metrics,
-        )
+        if args.stream:
+            print("\n" + "=" * 60)
+            print("SPECULATIVE DECODING OUTPUT")
+            print("=" * 60)
+            print(args.prompt, end="", flush=True)
+            pieces = []
+            for piece in decoder.generate_stream(
+                prompt=args.prompt,
+                max_new_tokens=args.max_tokens,
+                temperature=args.temperature,
+            ):
+                print(piece, end="", flush=True)
+                pieces.append(piece)
+            print("\n" + "=" * 60)
+            generated_text = args.prompt + "".join(pieces)
+            metrics = decoder.metrics.to_dict()
+        else:
+            result = decoder.generate(
+                prompt=args.prompt,
+                max_new_tokens=args.max_tokens,
+                temperature=args.temperature,
+                return_metrics=args.metrics,
+            )
+            if args.metrics:
+                generated_text, metrics = result
+            else:
+                generated_text = result
+
+            # Output results
+            print("\n" + "=" * 60)
+            print("SPECULATIVE DECODING OUTPUT")
+            print("=" * 60)
+            print(generated_text)
+            print("=" * 60)
 
         if args.metrics:
-            generated_text, metrics = result
             logger.info("Performance metrics:")
             for key, value in metrics.items():
                 logger.info(f"  {key}: {value}")
-        else:
-            generated_text = result
-
-        # Output results
-        print("\n" + "=" * 60)
-        print("SPECULATIVE DECODING OUTPUT")
-        print("=" * 60)
-        print(generated_text)
-        print("=" * 60)
 
         # Save to file if requested
         if args.output_file:
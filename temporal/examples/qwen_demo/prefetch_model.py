@@ -1,4 +1,11 @@
+import importlib.util
 import os
+
+# Rust multi-connection downloader; huggingface_hub reads this flag at import
+# time and errors out if it is set without the hf_transfer package installed.
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 from huggingface_hub import snapshot_download
 
 MODEL_ID = os.environ.get("QWEN_MODEL_ID", "Qwen/Qwen3-0.6B-Base")
@@ -13,6 +20,8 @@ def main() -> None:
             "*.model",
             "*.safetensors",
         ],
+        max_workers=8,
+        etag_timeout=30,
     )
     print(f"prefetched {MODEL_ID}")
 
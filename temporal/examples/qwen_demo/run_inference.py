@@ -8,25 +8,39 @@ MODEL_ID = os.environ.get("QWEN_MODEL_ID", "Qwen/Qwen3-0.6B-Base")
 DATASET_ID = os.environ.get("FINEWEB_DATASET_ID", "HuggingFaceFW/fineweb")
 MAX_ITEMS = int(os.environ.get("FINEWEB_ITEMS", "3"))
 MAX_NEW_TOKENS = int(os.environ.get("MAX_NEW_TOKENS", "32"))
+# "int8" (int8 weights on every nn.Linear), "bf16" or "none" (fp32)
+QUANTIZATION = os.environ.get("QWEN_QUANTIZATION", "int8")
+# 0 keeps torch's default of one thread per physical core
+NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", "0"))
 
 
 def main() -> None:
     os.environ["CUDA_VISIBLE_DEVICES"] = ""
     import torch  # imported after disabling CUDA
 
+    if QUANTIZATION not in ("none", "bf16", "int8"):
+        raise ValueError(f"unsupported QWEN_QUANTIZATION: {QUANTIZATION}")
+
     device = "cpu"
-    torch.set_num_threads(1)
+    if NUM_THREADS > 0:
+        torch.set_num_threads(NUM_THREADS)
 
-    print(f"loading model {MODEL_ID} on {device}...")
+    print(f"loading model {MODEL_ID} on {device} ({QUANTIZATION})...")
     tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, trust_remote_code=True)
     model = AutoModelForCausalLM.from_pretrained(
         MODEL_ID,
-        torch_dtype=torch.float32,
+        torch_dtype=torch.bfloat16 if QUANTIZATION == "bf16" else torch.float32,
         low_cpu_mem_usage=True,
         trust_remote_code=True,
     )
     model.to(device)
     model.eval()
+    if QUANTIZATION == "int8":
+        # Decode re-reads every weight per token, so it is bound by memory
+        # bandwidth; int8 weights move a quarter of the fp32 bytes
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
 
     print(f"streaming dataset {DATASET_ID}...")
     dataset = load_dataset(DATASET_ID, split="train", streaming=True)
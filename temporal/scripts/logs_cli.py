@@ -1,28 +1,136 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
 import json
 import os
+import struct
 import sys
 from collections import defaultdict
 from time import sleep
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:  # stdlib fallback; json.loads also accepts utf-8 bytes
+    _loads = json.loads
+
 
 def read_events(path):
     if not os.path.exists(path):
         return []
     events = []
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         for line in f:
-            line = line.strip()
-            if not line:
+            if not line.strip():
                 continue
             try:
-                events.append(json.loads(line))
-            except json.JSONDecodeError:
+                events.append(_loads(line))
+            except ValueError:
                 continue
     return events
 
 
+# Sidecar index: a header recording how much of the log is indexed, then one
+# (run key, byte offset) record per event line, so per-run queries seek straight
+# to their lines instead of parsing the whole log. Lines appended since the last
+# query are indexed incrementally from the recorded length.
+_INDEX_MAGIC = b"evidx\x00\x00\x01"
+_INDEX_HEADER = struct.Struct("<8sQQ")  # magic, log inode, indexed byte length
+_INDEX_RECORD = struct.Struct("<QQ")
+
+
+def _index_path(events_path):
+    return os.path.splitext(events_path)[0] + ".idx"
+
+
+def _run_key(workflow_id, run_id):
+    # Stable across processes, unlike hash(), so it can be persisted.
+    digest = hashlib.blake2b(
+        f"{workflow_id}\0{run_id}".encode("utf-8"), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _index_lines(events_path, start):
+    records = bytearray()
+    offset = start
+    with open(events_path, "rb") as f:
+        f.seek(start)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Still being written; indexed once it is complete.
+                break
+            line_start = offset
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                ev = _loads(line)
+            except ValueError:
+                continue
+            wf, run = ev.get("workflowId"), ev.get("runId")
+            if wf and run:
+                records += _INDEX_RECORD.pack(_run_key(wf, run), line_start)
+    return bytes(records), offset
+
+
+def _write_index(idx_path, inode, indexed, records):
+    tmp_path = f"{idx_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as out:
+            out.write(_INDEX_HEADER.pack(_INDEX_MAGIC, inode, indexed))
+            out.write(records)
+        os.replace(tmp_path, idx_path)
+    except OSError:
+        # Read-only log dir: still serve this query from memory.
+        pass
+
+
+def _load_index(events_path):
+    idx_path = _index_path(events_path)
+    st = os.stat(events_path)
+    try:
+        with open(idx_path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = b""
+    records, indexed = b"", 0
+    if len(data) >= _INDEX_HEADER.size:
+        magic, inode, length = _INDEX_HEADER.unpack_from(data)
+        # A replaced or truncated log invalidates the index.
+        if magic == _INDEX_MAGIC and inode == st.st_ino and length <= st.st_size:
+            records, indexed = data[_INDEX_HEADER.size :], length
+    if indexed < st.st_size:
+        new_records, end = _index_lines(events_path, indexed)
+        if end > indexed:
+            records += new_records
+            indexed = end
+            _write_index(idx_path, st.st_ino, indexed, records)
+    index = defaultdict(list)
+    for key, offset in _INDEX_RECORD.iter_unpack(records):
+        index[key].append(offset)
+    return index
+
+
+def read_run_events(events_path, workflow_id, run_id):
+    if not os.path.exists(events_path):
+        return []
+    offsets = _load_index(events_path).get(_run_key(workflow_id, run_id), [])
+    events = []
+    with open(events_path, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            try:
+                ev = _loads(f.readline())
+            except ValueError:
+                continue
+            # Guard against key collisions.
+            if ev.get("workflowId") == workflow_id and ev.get("runId") == run_id:
+                events.append(ev)
+    return events
+
+
 def list_runs(events):
     runs = {}
     for ev in events:
@@ -62,31 +170,44 @@ def show_steps(events, workflow_id, run_id):
 
 
 def tail(events_path, workflow_id, run_id):
-    events = read_events(events_path)
-    for ev in events:
-        if ev.get("workflowId") != workflow_id or ev.get("runId") != run_id:
-            continue
+    for ev in read_run_events(events_path, workflow_id, run_id):
         print(json.dumps(ev))
 
 
+def _poll_changes(interval=0.5):
+    while True:
+        sleep(interval)
+        yield None
+
+
 def follow(events_path, workflow_id, run_id):
     if not os.path.exists(events_path):
         print(f"events file not found: {events_path}", file=sys.stderr)
         return
-    with open(events_path, "r", encoding="utf-8") as f:
+    try:
+        # Block on inotify/kqueue/ReadDirectoryChangesW instead of polling.
+        from watchfiles import watch
+
+        # The defaults (step=50ms, debounce=1600ms) batch changes for up to 1.6s,
+        # which is slower than polling; flush each append almost immediately.
+        changes = watch(events_path, step=1, debounce=10)
+    except ImportError:
+        changes = _poll_changes()
+    with open(events_path, "rb") as f:
         f.seek(0, os.SEEK_END)
-        while True:
-            line = f.readline()
-            if not line:
-                sleep(0.5)
-                continue
-            try:
-                ev = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-            if ev.get("workflowId") != workflow_id or ev.get("runId") != run_id:
-                continue
-            print(json.dumps(ev), flush=True)
+        pending = b""
+        for _ in changes:
+            pending += f.read()
+            # Keep a partially written trailing line for the next wakeup.
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                try:
+                    ev = _loads(line)
+                except ValueError:
+                    continue
+                if ev.get("workflowId") != workflow_id or ev.get("runId") != run_id:
+                    continue
+                print(json.dumps(ev), flush=True)
 
 
 def main():
@@ -113,10 +234,10 @@ def main():
     args = parser.parse_args()
     events_path = os.path.join(args.log_dir, "events.jsonl")
 
-    events = read_events(events_path)
     if args.command == "list-runs":
-        list_runs(events)
+        list_runs(read_events(events_path))
     elif args.command == "show-steps":
+        events = read_run_events(events_path, args.workflow_id, args.run_id)
         show_steps(events, args.workflow_id, args.run_id)
     elif args.command == "tail":
         tail(events_path, args.workflow_id, args.run_id)